@@ -97,7 +97,7 @@ app.bringToFront();
   bat.open("w");
   bat.writeln("@echo off");
   bat.writeln("echo RUNNING> \"" + trapperLogPath + "\"");
-  bat.writeln("\"" + TRAPPER_EXE + "\" \"" + jobFolder + "\" " + trapPx + " 1>>\"" + trapperLogPath + "\" 2>>&1");
+  bat.writeln("\"" + TRAPPER_EXE + "\" \"" + jobFolder + "\" " + trapPx + " --mode " + $.global.PHASE2_MODE + " 1>>\"" + trapperLogPath + "\" 2>>&1");
   bat.writeln("echo ERRORLEVEL:%ERRORLEVEL%>> \"" + trapperLogPath + "\"");
   bat.writeln("echo %ERRORLEVEL%> \"" + errLvlPath + "\"");
   bat.close();
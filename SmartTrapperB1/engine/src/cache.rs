@@ -0,0 +1,117 @@
+// On-disk cache of per-source distance fields (--cache-dir).
+//
+// Jobs often reuse plates across reprints (a fixed KEY frame, a recurring
+// brand color). Every engine takes each source's distance field from here
+// (lib.rs cached_field()), stored to FAR-1 under the mask's content hash, so
+// a later job with the same mask at any trap width up to that reads it back
+// instead of growing the band again.
+//
+// An entry is a 16-byte header (magic, w, h, cap) followed by one byte per
+// pixel, so a file can be memory-mapped as is; here it is simply read. The
+// directory is kept under a byte cap by evicting the least recently used
+// entries, with a hit touching the file's mtime.
+//
+// Failures to write are logged by the caller and never fail a job.
+
+use crate::FAR;
+use anyhow::{Context, Result};
+use std::fs::{self, File};
+use std::io::Write;
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::time::SystemTime;
+
+const MAGIC:&[u8;4]=b"STD1";
+const HEADER:usize=16;
+const EXT:&str="dist";
+
+pub struct DistCache {
+    dir:PathBuf,
+    max_bytes:u64,
+    hits:AtomicUsize,
+    misses:AtomicUsize,
+}
+
+fn header(w:u32,h:u32,cap:u8)->[u8;HEADER]{
+    let mut b=[0u8;HEADER];
+    b[..4].copy_from_slice(MAGIC);
+    b[4..8].copy_from_slice(&w.to_le_bytes());
+    b[8..12].copy_from_slice(&h.to_le_bytes());
+    b[12]=cap;
+    b
+}
+
+impl DistCache {
+    pub fn open(dir:&Path,max_bytes:u64)->Result<Self>{
+        fs::create_dir_all(dir).with_context(||format!("creating cache dir {}",dir.display()))?;
+        Ok(DistCache{
+            dir:dir.to_path_buf(),
+            max_bytes,
+            hits:AtomicUsize::new(0),
+            misses:AtomicUsize::new(0),
+        })
+    }
+
+    fn path(&self,key:&str)->PathBuf{ self.dir.join(format!("{}.{}",key,EXT)) }
+
+    // Distance field for key if a stored one covers trap_px; a missing,
+    // foreign or too narrow entry is a miss.
+    pub fn get(&self,key:&str,w:u32,h:u32,trap_px:u8)->Option<Vec<u8>>{
+        let path=self.path(key);
+        let hit=fs::read(&path).ok().filter(|b|{
+            b.len()==HEADER+(w as usize)*(h as usize)
+                && b[..12]==header(w,h,0)[..12]
+                && b[12]>=trap_px && b[12]<FAR
+        });
+        let Some(mut bytes)=hit else {
+            self.misses.fetch_add(1,Ordering::Relaxed);
+            return None;
+        };
+        self.hits.fetch_add(1,Ordering::Relaxed);
+        let _=File::options().write(true).open(&path).and_then(|f|f.set_modified(SystemTime::now()));
+        bytes.drain(..HEADER);
+        Some(bytes)
+    }
+
+    // Written to a temp file and renamed, so concurrent jobs never read a
+    // partial entry.
+    pub fn put(&self,key:&str,w:u32,h:u32,cap:u8,dist:&[u8])->Result<()>{
+        let path=self.path(key);
+        let tmp=self.dir.join(format!("{}.{}.tmp",key,std::process::id()));
+        let written=File::create(&tmp)
+            .and_then(|mut f|{ f.write_all(&header(w,h,cap))?; f.write_all(dist) })
+            .and_then(|_|fs::rename(&tmp,&path));
+        if let Err(e)=written{
+            let _=fs::remove_file(&tmp);
+            return Err(e).with_context(||format!("writing {}",path.display()));
+        }
+        self.evict()
+    }
+
+    // Oldest entries first until the directory fits max_bytes.
+    fn evict(&self)->Result<()>{
+        let mut entries=Vec::new();
+        for e in fs::read_dir(&self.dir)?{
+            let path=e?.path();
+            if path.extension().map_or(true,|x|x!=EXT){continue;}
+            let Ok(meta)=fs::metadata(&path) else { continue; };
+            entries.push((meta.modified().unwrap_or(SystemTime::UNIX_EPOCH),meta.len(),path));
+        }
+        let mut total:u64=entries.iter().map(|e|e.1).sum();
+        entries.sort();
+        for (_,len,path) in entries{
+            if total<=self.max_bytes{break;}
+            if fs::remove_file(&path).is_ok(){ total-=len; }
+        }
+        Ok(())
+    }
+
+    pub fn report(&self){
+        println!(
+            "cache {}: {} hits, {} misses",
+            self.dir.display(),
+            self.hits.load(Ordering::Relaxed),
+            self.misses.load(Ordering::Relaxed),
+        );
+    }
+}
@@ -0,0 +1,167 @@
+// Single-pass trapping over a label map.
+//
+// Every pixel records the topmost printing color (0 = paper, k+1 = job.colors[k]),
+// so all color-to-color boundaries are found in one sweep instead of one
+// sweep per pair. Traps are then grown from boundary pixels only, one ring
+// per pixel of trapPx, one source color at a time, so the cost is the band
+// area around each source rather than its boundary times a diamond. A
+// source's (source, target) buckets are emitted before the next source
+// starts, so at most one source's traps are alive at once.
+//
+// A label map can only hold one color per pixel, so it is exact only when
+// separations do not overlap. build() returns None otherwise and the
+// caller falls back to the pairwise engine.
+
+use crate::cache::DistCache;
+use crate::{cached_field, dirs8, Emit};
+use anyhow::Result;
+use std::collections::HashSet;
+
+pub enum LabelMap {
+    U8(Vec<u8>),
+    U16(Vec<u16>),
+}
+
+fn build_as<L>(plates:&[&[u8]],n:usize)->Option<Vec<L>>
+where L:Copy+Default+PartialEq+TryFrom<usize>{
+    let mut labels=vec![L::default();n];
+    for (k,p) in plates.iter().enumerate(){
+        let l=L::try_from(k+1).ok()?;
+        for i in 0..n{
+            if p[i]==0{continue;}
+            if labels[i]!=L::default(){ return None; } // overlap
+            labels[i]=l;
+        }
+    }
+    Some(labels)
+}
+
+// Label map in stack order, or None if any two separations overlap.
+pub fn build(plates:&[&[u8]],n:usize)->Option<LabelMap>{
+    if plates.len()<=u8::MAX as usize{
+        build_as::<u8>(plates,n).map(LabelMap::U8)
+    } else if plates.len()<=u16::MAX as usize{
+        build_as::<u16>(plates,n).map(LabelMap::U16)
+    } else {
+        None
+    }
+}
+
+// Same output as the pairwise rule: for every pair that touches
+// (8-neighborhood), the upper plate's pixels within trap_px (4-connected
+// distance) of the lower plate. Streamed to emit in (lower, upper) order.
+// plates are the ones map was built from; with a cache, each source's band
+// comes from its cached_field() instead of being grown.
+pub fn traps(map:&LabelMap,plates:&[&[u8]],w:u32,h:u32,trap_px:i32,cache:Option<&DistCache>,emit:&mut Emit)->Result<()>{
+    match map{
+        LabelMap::U8(l)=>traps_as(l,plates,w,h,trap_px,cache,emit),
+        LabelMap::U16(l)=>traps_as(l,plates,w,h,trap_px,cache,emit),
+    }
+}
+
+fn traps_as<L:Copy+Into<usize>>(labels:&[L],plates:&[&[u8]],w:u32,h:u32,trap_px:i32,cache:Option<&DistCache>,emit:&mut Emit)->Result<()>{
+    let ncolors=plates.len();
+    let n=(w*h)as usize;
+    let (wi,hi)=(w as i32,h as i32);
+    let at=|x:i32,y:i32|->usize{ labels[(y as u32*w+x as u32)as usize].into() };
+
+    // Sweep 1: which pairs touch
+    let mut touching=HashSet::new();
+    for y in 0..hi{
+        for x in 0..wi{
+            let la=at(x,y);
+            if la==0{continue;}
+            for (dx,dy) in dirs8(){
+                let nx=x+dx;
+                let ny=y+dy;
+                if nx<0||ny<0||nx>=wi||ny>=hi{continue;}
+                let lb=at(nx,ny);
+                if lb==0||lb==la{continue;}
+                touching.insert((la.min(lb)-1,la.max(lb)-1));
+            }
+        }
+    }
+
+    let mut pairs:Vec<(usize,usize)>=touching.into_iter().collect();
+    pairs.sort();
+    let mut is_lower=vec![false;ncolors];
+    for &(a,_) in &pairs{ is_lower[a]=true; }
+
+    // 4-boundary pixels of every color that spreads into another. The
+    // nearest pixel of a plate to any outside pixel is always one of them,
+    // so growing only those reproduces the full distance test.
+    let mut edges:Vec<Vec<usize>>=vec![Vec::new();ncolors];
+    for y in 0..hi{
+        for x in 0..wi{
+            let la=at(x,y);
+            if la==0||!is_lower[la-1]{continue;}
+            let edge=[(1,0),(-1,0),(0,1),(0,-1)].iter().any(|&(dx,dy)|{
+                let nx=x+dx;
+                let ny=y+dy;
+                nx>=0&&ny>=0&&nx<wi&&ny<hi&&at(nx,ny)!=la
+            });
+            if edge{ edges[la-1].push((y as u32*w+x as u32)as usize); }
+        }
+    }
+
+    // Sweep 2, per source color: its band is grown one ring at a time from
+    // its boundary pixels, as in edge_grow(), so each pixel within trap_px
+    // is reached once per source (or read off its cached distance field).
+    // Upper pixels reached go into that pair's bucket; the buckets are
+    // flushed in order before the next source.
+    let (wu,hu)=(w as usize,h as usize);
+    let mut slot=vec![usize::MAX;ncolors];
+    let mut seen=vec![false;n];
+    let mut reached:Vec<usize>=Vec::new();
+    let mut frontier:Vec<usize>=Vec::new();
+    let mut next:Vec<usize>=Vec::new();
+    for group in pairs.chunk_by(|p,q|p.0==q.0){
+        let la=group[0].0+1;
+        for (k,&(_,b)) in group.iter().enumerate(){ slot[b]=k; }
+        let mut buckets:Vec<Option<Vec<u8>>>=vec![None;group.len()];
+
+        let mut add=|j:usize,lb:usize|{
+            let k=slot[lb-1];
+            if k!=usize::MAX{ buckets[k].get_or_insert_with(||vec![0u8;n])[j]=1; }
+        };
+
+        if let Some(field)=cached_field(plates[la-1],w,h,trap_px,cache){
+            for (j,&d) in field.iter().enumerate(){
+                let lb:usize=labels[j].into();
+                if lb>la&&d as i32<=trap_px{ add(j,lb); }
+            }
+        } else {
+            frontier.clear();
+            frontier.extend_from_slice(&edges[la-1]);
+            for &i in &frontier{ seen[i]=true; }
+            reached.extend_from_slice(&frontier);
+            for _ in 0..trap_px.max(0){
+                if frontier.is_empty(){break;}
+                for &i in &frontier{
+                    let (x,y)=(i%wu,i/wu);
+                    let around=[(x>0,i.wrapping_sub(1)),(x+1<wu,i+1),(y>0,i.wrapping_sub(wu)),(y+1<hu,i+wu)];
+                    for (inside,j) in around{
+                        if !inside||seen[j]{continue;}
+                        let lb:usize=labels[j].into();
+                        // the nearest source pixel is always a boundary one,
+                        // so the source's own interior is never entered
+                        if lb==la{continue;}
+                        seen[j]=true;
+                        next.push(j);
+                        if lb>la{ add(j,lb); } // only upper plates receive the spread
+                    }
+                }
+                reached.extend_from_slice(&next);
+                std::mem::swap(&mut frontier,&mut next);
+                next.clear();
+            }
+            for i in reached.drain(..){ seen[i]=false; }
+        }
+
+        for (&(a,b),m) in group.iter().zip(buckets){
+            slot[b]=usize::MAX;
+            if let Some(m)=m{ emit(a,b,m)?; }
+        }
+    }
+    Ok(())
+}
@@ -0,0 +1,741 @@
+// Trapping core shared by the job-folder CLI (main.rs) and the Python module.
+//
+// Plates are alpha masks in job.colors order (bottom -> top), one byte per
+// pixel, nonzero = ink. Traps come back as (lower, upper, mask) with the
+// lower plate spreading into the upper one.
+
+use anyhow::Result;
+use clap::ValueEnum;
+use cache::DistCache;
+use rle::RleMask;
+use std::collections::{HashSet, VecDeque};
+
+pub mod cache;
+pub mod labelmap;
+pub mod objects;
+pub mod preview;
+pub mod rle;
+#[cfg(feature="python")]
+mod python;
+
+/// Receives each finished trap as (lower, upper, mask).
+pub type Emit<'a>=dyn FnMut(usize,usize,Vec<u8>)->Result<()>+'a;
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq, ValueEnum)]
+pub enum Mode {
+    /// Auto-knockout: the pairwise spread rule.
+    Plates,
+    /// Keep overlaps, trap the outer boundary only.
+    Overprint,
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq, ValueEnum)]
+pub enum Engine {
+    /// Labelmap when separations don't overlap, else objects or pairwise.
+    Auto,
+    Pairwise,
+    Labelmap,
+    /// Connected components + bbox index, trapped only where objects meet.
+    Objects,
+    /// Objects or pairwise, picked by content as auto does, never the label
+    /// map (which holds one source color's traps at once).
+    NoLabelmap,
+}
+
+pub fn any_on(m:&[u8])->bool{ m.iter().any(|&v|v!=0) }
+
+pub fn dirs8()->[(i32,i32);8]{
+    [(-1,0),(1,0),(0,-1),(0,1),(-1,-1),(-1,1),(1,-1),(1,1)]
+}
+
+// Overprint keeps intentional overlaps: a lower plate may only spread into
+// pixels where the target prints alone (nothing below or above it).
+// The below/above unions are running prefix/suffix accumulators, one pass
+// each way, so only the targets and one union are alive at once.
+pub fn overprint_targets(plates:&[&[u8]],n:usize)->Vec<Vec<u8>>{
+    let mut acc=vec![0u8;n];
+    let mut out=Vec::with_capacity(plates.len());
+    for p in plates{
+        out.push((0..n).map(|i|(p[i]!=0 && acc[i]==0) as u8).collect::<Vec<u8>>());
+        for i in 0..n{ acc[i]|=(p[i]!=0) as u8; }
+    }
+
+    acc.fill(0);
+    for (p,t) in plates.iter().zip(&mut out).rev(){
+        for i in 0..n{
+            t[i]&=(acc[i]==0) as u8;
+            acc[i]|=(p[i]!=0) as u8;
+        }
+    }
+    out
+}
+
+pub fn edt(mask:&[u8],w:u32,h:u32)->Vec<f32>{
+    let n=(w*h)as usize;
+    let mut dist=vec![1e9f32;n];
+    let mut q=VecDeque::new();
+
+    for i in 0..n{
+        if mask[i]!=0{ dist[i]=0.0; q.push_back(i); }
+    }
+
+    while let Some(idx)=q.pop_front(){
+        let x=(idx as u32%w)as i32;
+        let y=(idx as u32/w)as i32;
+
+        for (dx,dy) in [(1,0),(-1,0),(0,1),(0,-1)]{
+            let nx=x+dx;
+            let ny=y+dy;
+            if nx<0||ny<0||nx>=w as i32||ny>=h as i32{continue;}
+            let nidx=(ny as u32*w+nx as u32)as usize;
+            if dist[nidx]>dist[idx]+1.0{
+                dist[nidx]=dist[idx]+1.0;
+                q.push_back(nidx);
+            }
+        }
+    }
+    dist
+}
+
+// Every byte of an 8-byte word nonzero.
+fn all_on8(v:u64)->bool{
+    const LO:u64=0x0101010101010101;
+    const HI:u64=0x8080808080808080;
+    v.wrapping_sub(LO)&!v&HI==0
+}
+
+fn word(m:&[u8],i:usize)->u64{ u64::from_le_bytes(m[i..i+8].try_into().unwrap()) }
+
+// Boundary growth behind edge_dilate() and edge_distance(). The nearest
+// pixel of a set is always on its boundary, so only boundary pixels seed the
+// growth: the mask is copied word-wise (empty and interior words are skipped
+// in one step), then the band is grown one layer per pixel of radius,
+// visiting each band pixel once. Cost beyond the copy is ~ perimeter x r.
+// Pixels start at off, mask pixels get layer(0), pixels k steps out layer(k).
+fn edge_grow(mask:&[u8],w:u32,h:u32,r:u32,off:u8,layer:impl Fn(u32)->u8)->Vec<u8>{
+    let (wu,hu)=(w as usize,h as usize);
+    let mut out=vec![off;wu*hu];
+    let mut frontier:Vec<usize>=Vec::new();
+    let on=layer(0);
+
+    for y in 0..hu{
+        let row=y*wu;
+        let mut x=0;
+        while x<wu{
+            let i=row+x;
+            if x+8<=wu{
+                let v=word(mask,i);
+                if v==0{ x+=8; continue; }
+                if all_on8(v)
+                    && (y==0||all_on8(word(mask,i-wu)))
+                    && (y+1==hu||all_on8(word(mask,i+wu)))
+                    && (x==0||mask[i-1]!=0)
+                    && (x+8==wu||mask[i+8]!=0){
+                    out[i..i+8].fill(on);
+                    x+=8;
+                    continue;
+                }
+            }
+            if mask[i]!=0{
+                out[i]=on;
+                let edge=(x>0&&mask[i-1]==0)||(x+1<wu&&mask[i+1]==0)
+                    ||(y>0&&mask[i-wu]==0)||(y+1<hu&&mask[i+wu]==0);
+                if edge{ frontier.push(i); }
+            }
+            x+=1;
+        }
+    }
+
+    let mut next=Vec::with_capacity(frontier.len());
+    for k in 1..=r{
+        if frontier.is_empty(){break;}
+        let v=layer(k);
+        for &i in &frontier{
+            let (x,y)=(i%wu,i/wu);
+            if x>0&&out[i-1]==off{ out[i-1]=v; next.push(i-1); }
+            if x+1<wu&&out[i+1]==off{ out[i+1]=v; next.push(i+1); }
+            if y>0&&out[i-wu]==off{ out[i-wu]=v; next.push(i-wu); }
+            if y+1<hu&&out[i+wu]==off{ out[i+wu]=v; next.push(i+wu); }
+        }
+        std::mem::swap(&mut frontier,&mut next);
+        next.clear();
+    }
+    out
+}
+
+// Pixels within 4-connected distance trap_px of mask, as 0/1 (the mask
+// itself included), i.e. edt(mask) <= trap_px.
+pub fn edge_dilate(mask:&[u8],w:u32,h:u32,trap_px:i32)->Vec<u8>{
+    edge_grow(mask,w,h,trap_px.max(0)as u32,0,|_|1)
+}
+
+/// edge_distance() value for pixels farther than its cap.
+pub const FAR:u8=255;
+
+// 4-connected distance to mask clipped at cap (<= 254): exact up to cap,
+// FAR beyond it. dist <= r matches edge_dilate(r) for every r <= cap.
+pub fn edge_distance(mask:&[u8],w:u32,h:u32,cap:u8)->Vec<u8>{
+    edge_grow(mask,w,h,cap.min(FAR-1)as u32,FAR,|k|k as u8)
+}
+
+const P1:u64=0x9E3779B185EBCA87;
+const P2:u64=0xC2B2AE3D27D4EB4F;
+const P3:u64=0x165667B19E3779F9;
+const P4:u64=0x85EBCA77C2B2AE63;
+const P5:u64=0x27D4EB2F165667C5;
+
+fn xxh_round(acc:u64,v:u64)->u64{ acc.wrapping_add(v.wrapping_mul(P2)).rotate_left(31).wrapping_mul(P1) }
+
+fn xxh_merge(acc:u64,v:u64)->u64{ (acc^xxh_round(0,v)).wrapping_mul(P1).wrapping_add(P4) }
+
+fn read64(b:&[u8])->u64{ u64::from_le_bytes(b[..8].try_into().unwrap()) }
+
+// XXH64, per the reference specification.
+fn xxh64(data:&[u8],seed:u64)->u64{
+    let mut stripes=data.chunks_exact(32);
+    let mut h=if data.len()>=32{
+        let mut v=[seed.wrapping_add(P1).wrapping_add(P2),seed.wrapping_add(P2),seed,seed.wrapping_sub(P1)];
+        for s in &mut stripes{
+            for (k,acc) in v.iter_mut().enumerate(){ *acc=xxh_round(*acc,read64(&s[k*8..])); }
+        }
+        let mut h=v[0].rotate_left(1).wrapping_add(v[1].rotate_left(7))
+            .wrapping_add(v[2].rotate_left(12)).wrapping_add(v[3].rotate_left(18));
+        for acc in v{ h=xxh_merge(h,acc); }
+        h
+    } else {
+        seed.wrapping_add(P5)
+    };
+    h=h.wrapping_add(data.len()as u64);
+
+    let mut rest=stripes.remainder();
+    while rest.len()>=8{
+        h=(h^xxh_round(0,read64(rest))).rotate_left(27).wrapping_mul(P1).wrapping_add(P4);
+        rest=&rest[8..];
+    }
+    if rest.len()>=4{
+        let v=u32::from_le_bytes(rest[..4].try_into().unwrap())as u64;
+        h=(h^v.wrapping_mul(P1)).rotate_left(23).wrapping_mul(P2).wrapping_add(P3);
+        rest=&rest[4..];
+    }
+    for &b in rest{
+        h=(h^(b as u64).wrapping_mul(P5)).rotate_left(11).wrapping_mul(P1);
+    }
+    h^=h>>33;
+    h=h.wrapping_mul(P2);
+    h^=h>>29;
+    h=h.wrapping_mul(P3);
+    h^h>>32
+}
+
+// 128-bit content hash: XXH64 under two seeds derived from the canvas size.
+// Stable across builds, unlike std's DefaultHasher; every input byte
+// reaches every output bit.
+pub fn mask_hash(mask:&[u8],w:u32,h:u32)->String{
+    let seed=(w as u64)<<32|h as u64;
+    format!("{:016x}{:016x}",xxh64(mask,seed),xxh64(mask,seed^P3))
+}
+
+// Distance field of one source through the cache: read back when a stored
+// one covers trap_px, else computed to FAR-1 and stored, so any later job or
+// width up to that reads it back. None without a cache or for widths u8
+// distances can't hold. The cache is only an optimisation: a failed write
+// is logged and the job carries on.
+pub fn cached_field(src:&[u8],w:u32,h:u32,trap_px:i32,cache:Option<&DistCache>)->Option<Vec<u8>>{
+    let cache=cache.filter(|_|trap_px<FAR as i32)?;
+    let key=mask_hash(src,w,h);
+    if let Some(d)=cache.get(&key,w,h,trap_px as u8){ return Some(d); }
+    let d=edge_distance(src,w,h,FAR-1);
+    if let Err(e)=cache.put(&key,w,h,FAR-1,&d){
+        eprintln!("warning: distance cache write failed, continuing: {:#}",e);
+    }
+    Some(d)
+}
+
+// src grown by trap_px, visited over window [x0,x1) x [y0,y1): f gets the
+// index of every grown pixel. With the source's cached_field() that is a
+// threshold; otherwise the distance is computed on the window grown by
+// trap_px: a 4-connected path of length <= trap_px never leaves it, so the
+// result is exact.
+fn grow_window(src:&[u8],field:Option<&[u8]>,w:u32,h:u32,trap_px:i32,tile:(u32,u32,u32,u32),mut f:impl FnMut(usize)){
+    let (x0,y0,x1,y1)=tile;
+    if let Some(field)=field{
+        for y in y0..y1{
+            for x in x0..x1{
+                let idx=(y*w+x)as usize;
+                if field[idx]as i32<=trap_px{ f(idx); }
+            }
+        }
+        return;
+    }
+
+    let r=trap_px as u32;
+    let (wx0,wy0)=(x0.saturating_sub(r),y0.saturating_sub(r));
+    let (wx1,wy1)=((x1+r).min(w),(y1+r).min(h));
+    let ww=wx1-wx0;
+
+    let mut win=Vec::with_capacity((ww*(wy1-wy0))as usize);
+    for y in wy0..wy1{
+        let row=(y*w)as usize;
+        win.extend_from_slice(&src[row+wx0 as usize..row+wx1 as usize]);
+    }
+    let grown=edge_dilate(&win,ww,wy1-wy0,trap_px);
+
+    for y in y0..y1{
+        for x in x0..x1{
+            if grown[((y-wy0)*ww+(x-wx0))as usize]!=0{ f((y*w+x)as usize); }
+        }
+    }
+}
+
+// Trap of src into tgt inside window [x0,x1) x [y0,y1), ORed into out.
+// field is src's cached_field(), if any.
+pub fn trap_in_window(src:&[u8],field:Option<&[u8]>,tgt:&[u8],w:u32,h:u32,trap_px:i32,tile:(u32,u32,u32,u32),out:&mut [u8]){
+    grow_window(src,field,w,h,trap_px,tile,|idx| if tgt[idx]!=0{ out[idx]=1; });
+}
+
+// edge_dilate() of src inside window [x0,x1) x [y0,y1), ORed into out.
+pub fn dilate_in_window(src:&[u8],field:Option<&[u8]>,w:u32,h:u32,trap_px:i32,tile:(u32,u32,u32,u32),out:&mut [u8]){
+    grow_window(src,field,w,h,trap_px,tile,|idx| out[idx]=1);
+}
+
+// Pairs (lower, upper) with a pixel of one 8-adjacent to a pixel of the other.
+pub fn touching_pairs(plates:&[&[u8]],w:u32,h:u32)->Vec<(usize,usize)>{
+    let mut pair_boundary=HashSet::new();
+    let neigh=dirs8();
+
+    for y in 0..h as i32{
+        for x in 0..w as i32{
+            let idx=(y as u32*w+x as u32)as usize;
+
+            for (dx,dy) in neigh{
+                let nx=x+dx;
+                let ny=y+dy;
+                if nx<0||ny<0||nx>=w as i32||ny>=h as i32{continue;}
+                let nidx=(ny as u32*w+nx as u32)as usize;
+
+                for a in 0..plates.len(){
+                    if plates[a][idx]==0{continue;}
+                    for b in 0..plates.len(){
+                        if a==b{continue;}
+                        if plates[b][nidx]==0{continue;}
+                        pair_boundary.insert((a.min(b),a.max(b)));
+                    }
+                }
+            }
+        }
+    }
+
+    let mut pairs:Vec<(usize,usize)>=pair_boundary.into_iter().collect();
+    pairs.sort();
+    pairs
+}
+
+// A source grown by trap_px: run lists for sparse plates, else dense 0/1.
+enum Band {
+    Rle(RleMask),
+    Dense(Vec<u8>),
+}
+
+// Reference rule: for every pair of plates that touch (8-neighborhood),
+// the upper plate's pixels within trap_px of the lower plate.
+// Plates sparse enough for run lists are dilated by interval expansion,
+// the rest by growing their boundary pixels; the result is the same.
+// With a cache every source's band comes from its cached_field() instead.
+// Each trap is handed to emit as soon as it is done, in (lower, upper) order.
+pub fn pairwise_traps(plates:&[&[u8]],mode:Mode,w:u32,h:u32,trap_px:i32,cache:Option<&DistCache>,emit:&mut Emit)->Result<()>{
+    let n=(w*h)as usize;
+    let rles:Vec<Option<RleMask>>=plates.iter().map(|p|rle::encode_if_sparse(p,w,h,trap_px)).collect();
+    let all_rle:Option<Vec<&RleMask>>=rles.iter().map(Option::as_ref).collect();
+
+    let pairs=match &all_rle{
+        Some(r)=>rle::touching_pairs(r),
+        None=>touching_pairs(plates,w,h),
+    };
+    let (targets,rle_targets)=match (mode,&all_rle){
+        (Mode::Plates,_)=>(None,None),
+        (Mode::Overprint,Some(r))=>(None,Some(rle::overprint_targets(r))),
+        (Mode::Overprint,None)=>(Some(overprint_targets(plates,n)),None),
+    };
+
+    // pairs are sorted by lower, so one band is kept at a time
+    let mut band:Option<(usize,Band)>=None;
+
+    for (lower,upper) in pairs{
+        if band.as_ref().map_or(true,|b|b.0!=lower){
+            let grown=match (cached_field(plates[lower],w,h,trap_px,cache),&rles[lower]){
+                (Some(d),_)=>Band::Dense(d.iter().map(|&d|(d as i32<=trap_px) as u8).collect()),
+                (None,Some(src))=>Band::Rle(src.dilate(trap_px)),
+                (None,None)=>Band::Dense(edge_dilate(plates[lower],w,h,trap_px)),
+            };
+            band=Some((lower,grown));
+        }
+        let trap_mask=match &band.as_ref().unwrap().1{
+            Band::Rle(grown)=>match (&rle_targets,&targets,&rles[upper]){
+                (Some(t),_,_)=>grown.and(&t[upper]).to_dense(),
+                (None,None,Some(t))=>grown.and(t).to_dense(),
+                (None,t,_)=>grown.and_dense(t.as_ref().map_or(plates[upper],|t|&t[upper])),
+            },
+            Band::Dense(grown)=>{
+                let rle_target=rle_targets.as_ref().map(|t|t[upper].to_dense());
+                let target=rle_target.as_deref().or(targets.as_ref().map(|t|t[upper].as_slice())).unwrap_or(plates[upper]);
+                grown.iter().zip(target).map(|(&g,&t)|g&(t!=0) as u8).collect()
+            }
+        };
+
+        if any_on(&trap_mask){ emit(lower,upper,trap_mask)?; }
+    }
+    Ok(())
+}
+
+// Runs the requested engine, streaming traps to emit; returns the engine
+// that actually ran (Auto resolves to Labelmap, Objects or Pairwise,
+// NoLabelmap to Objects or Pairwise).
+// Every engine takes its per-source distances from cache, if given.
+pub fn compute_traps_each(plates:&[&[u8]],w:u32,h:u32,trap_px:i32,mode:Mode,engine:Engine,cache:Option<&DistCache>,emit:&mut Emit)->Result<Engine>{
+    let n=(w*h)as usize;
+
+    let labels=match engine{
+        Engine::Auto|Engine::Labelmap=>labelmap::build(plates,n),
+        _=>None,
+    };
+    if engine==Engine::Labelmap && labels.is_none(){
+        anyhow::bail!("label-map engine needs non-overlapping separations");
+    }
+
+    // Disjoint plates print alone everywhere, so both modes agree there.
+    if let Some(map)=&labels{
+        labelmap::traps(map,plates,w,h,trap_px,cache,emit)?;
+        return Ok(Engine::Labelmap);
+    }
+
+    let comps=match engine{
+        Engine::Auto|Engine::Objects|Engine::NoLabelmap=>Some(objects::index(plates,w,h)),
+        _=>None,
+    };
+    match comps{
+        Some(c) if engine==Engine::Objects || objects::worthwhile(&c,w,h,trap_px)=>{
+            objects::traps_each(plates,c,mode,w,h,trap_px,cache,emit)?;
+            Ok(Engine::Objects)
+        }
+        _=>{
+            pairwise_traps(plates,mode,w,h,trap_px,cache,emit)?;
+            Ok(Engine::Pairwise)
+        }
+    }
+}
+
+// compute_traps_each() collected into (lower, upper, mask), sorted.
+pub fn compute_traps(plates:&[&[u8]],w:u32,h:u32,trap_px:i32,mode:Mode,engine:Engine,cache:Option<&DistCache>)->Result<(Engine,Vec<(usize,usize,Vec<u8>)>)>{
+    let mut traps=Vec::new();
+    let engine=compute_traps_each(plates,w,h,trap_px,mode,engine,cache,&mut |lower,upper,mask|{
+        traps.push((lower,upper,mask));
+        Ok(())
+    })?;
+    Ok((engine,traps))
+}
+
+// Every engine and building block against a brute-force reference: explicit
+// 8-neighbour touch test, edt() threshold, "prints alone" targets.
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::cache::DistCache;
+
+    type Traps=Vec<(usize,usize,Vec<u8>)>;
+
+    const WIDTHS:[i32;5]=[0,1,2,3,5];
+
+    struct Rng(u64);
+
+    impl Rng {
+        fn next(&mut self)->u64{
+            self.0^=self.0<<13;
+            self.0^=self.0>>7;
+            self.0^=self.0<<17;
+            self.0
+        }
+        fn below(&mut self,n:u32)->u32{ (self.next()%n as u64)as u32 }
+        // nonzero ink comes as 1 or 255, like CLI and numpy masks
+        fn ink(&mut self)->u8{ if self.next()&1==0{ 1 } else { 255 } }
+    }
+
+    fn noise(rng:&mut Rng,w:u32,h:u32,pct:u32)->Vec<u8>{
+        (0..w*h).map(|_| if rng.below(100)<pct{ rng.ink() } else { 0 }).collect()
+    }
+
+    fn rects(rng:&mut Rng,w:u32,h:u32,count:u32)->Vec<u8>{
+        let mut m=vec![0u8;(w*h)as usize];
+        for _ in 0..count{
+            let (x0,y0)=(rng.below(w),rng.below(h));
+            let (x1,y1)=((x0+1+rng.below(w/2+1)).min(w),(y0+1+rng.below(h/2+1)).min(h));
+            let v=rng.ink();
+            for y in y0..y1{
+                for x in x0..x1{ m[(y*w+x)as usize]=v; }
+            }
+        }
+        m
+    }
+
+    // Each pixel goes to at most one plate.
+    fn disjoint(rng:&mut Rng,w:u32,h:u32,plates:usize,pct:u32)->Vec<Vec<u8>>{
+        let mut out=vec![vec![0u8;(w*h)as usize];plates];
+        let label=rects(rng,w,h,6);
+        for i in 0..(w*h)as usize{
+            if rng.below(100)>=pct{continue;}
+            let k=(label[i]as usize+i/(w as usize*2))%plates;
+            out[k][i]=1;
+        }
+        out
+    }
+
+    fn touches(a:&[u8],b:&[u8],w:u32,h:u32)->bool{
+        (0..(w*h)as usize).any(|i|{
+            let (x,y)=((i as u32%w)as i32,(i as u32/w)as i32);
+            b[i]!=0 && dirs8().iter().any(|&(dx,dy)|{
+                let (nx,ny)=(x+dx,y+dy);
+                nx>=0&&ny>=0&&nx<w as i32&&ny<h as i32&&a[(ny as u32*w+nx as u32)as usize]!=0
+            })
+        })
+    }
+
+    fn prints_alone(plates:&[&[u8]],k:usize,i:usize)->bool{
+        plates.iter().enumerate().all(|(j,q)|j==k||q[i]==0)
+    }
+
+    fn reference(plates:&[&[u8]],mode:Mode,w:u32,h:u32,r:i32)->Traps{
+        let mut out=Vec::new();
+        for lower in 0..plates.len(){
+            let dist=edt(plates[lower],w,h);
+            for upper in lower+1..plates.len(){
+                if !touches(plates[lower],plates[upper],w,h){continue;}
+                let mask:Vec<u8>=(0..(w*h)as usize).map(|i|{
+                    let target=plates[upper][i]!=0 && (mode==Mode::Plates||prints_alone(plates,upper,i));
+                    (target && dist[i]<=r as f32) as u8
+                }).collect();
+                if any_on(&mask){ out.push((lower,upper,mask)); }
+            }
+        }
+        out
+    }
+
+    fn collect(run:impl FnOnce(&mut Emit)->Result<()>)->Traps{
+        let mut out=Vec::new();
+        run(&mut |a,b,m|{ out.push((a,b,m)); Ok(()) }).unwrap();
+        out
+    }
+
+    fn rgba(mask:&[u8])->Vec<u8>{
+        mask.iter().flat_map(|&v|[0,0,0,if v!=0{ 255 } else { 0 }]).collect()
+    }
+
+    fn check_blocks(plates:&[&[u8]],w:u32,h:u32){
+        let rles:Vec<RleMask>=plates.iter().map(|p|RleMask::from_dense(p,w,h)).collect();
+        let refs:Vec<&RleMask>=rles.iter().collect();
+
+        let mut pairs=Vec::new();
+        for a in 0..plates.len(){
+            for b in a+1..plates.len(){
+                if touches(plates[a],plates[b],w,h){ pairs.push((a,b)); }
+            }
+        }
+        assert_eq!(touching_pairs(plates,w,h),pairs,"touching_pairs");
+        assert_eq!(rle::touching_pairs(&refs),pairs,"rle::touching_pairs");
+
+        let alone:Vec<Vec<u8>>=(0..plates.len()).map(|k|{
+            (0..(w*h)as usize).map(|i|(plates[k][i]!=0&&prints_alone(plates,k,i))as u8).collect()
+        }).collect();
+        assert_eq!(overprint_targets(plates,(w*h)as usize),alone,"overprint_targets");
+        let rle_alone:Vec<Vec<u8>>=rle::overprint_targets(&refs).iter().map(|m|m.to_dense()).collect();
+        assert_eq!(rle_alone,alone,"rle::overprint_targets");
+
+        for (p,m) in plates.iter().zip(&rles){
+            let dist=edt(p,w,h);
+            for r in WIDTHS{
+                let want:Vec<u8>=dist.iter().map(|&d|(d<=r as f32)as u8).collect();
+                assert_eq!(edge_dilate(p,w,h,r),want,"edge_dilate r={}",r);
+                assert_eq!(m.dilate(r).to_dense(),want,"RleMask::dilate r={}",r);
+                let field=edge_distance(p,w,h,r as u8);
+                let from_field:Vec<u8>=field.iter().map(|&d|(d<=r as u8)as u8).collect();
+                assert_eq!(from_field,want,"edge_distance r={}",r);
+            }
+        }
+    }
+
+    fn check_engines(plates:&[&[u8]],w:u32,h:u32){
+        let n=(w*h)as usize;
+        let disjoint=(0..n).all(|i|plates.iter().filter(|p|p[i]!=0).count()<=1);
+        check_blocks(plates,w,h);
+
+        for mode in [Mode::Plates,Mode::Overprint]{
+            let targets=match mode{
+                Mode::Plates=>None,
+                Mode::Overprint=>Some(overprint_targets(plates,n)),
+            };
+            for r in WIDTHS{
+                let want=reference(plates,mode,w,h,r);
+                let ctx=format!("{}x{} {:?} r={}",w,h,mode,r);
+
+                assert_eq!(collect(|e|pairwise_traps(plates,mode,w,h,r,None,e)),want,"pairwise {}",ctx);
+                for engine in [Engine::Auto,Engine::Pairwise,Engine::Objects,Engine::NoLabelmap]{
+                    let (_,got)=compute_traps(plates,w,h,r,mode,engine,None).unwrap();
+                    assert_eq!(got,want,"{:?} {}",engine,ctx);
+                }
+                let labelmap=compute_traps(plates,w,h,r,mode,Engine::Labelmap,None);
+                if disjoint{
+                    assert_eq!(labelmap.unwrap().1,want,"labelmap {}",ctx);
+                } else {
+                    assert!(labelmap.is_err(),"labelmap accepted overlapping plates {}",ctx);
+                }
+
+                for scale in [2,3]{
+                    let coarse:Vec<Vec<u8>>=plates.iter().map(|p|preview::downsample_alpha(w,h,&rgba(p),scale)).collect();
+                    let got=collect(|e|preview::refine(plates,targets.as_deref(),&coarse,w,h,scale,r,None,e));
+                    assert_eq!(got,want,"refine 1/{} {}",scale,ctx);
+                }
+            }
+        }
+    }
+
+    fn run(stack:&[Vec<u8>],w:u32,h:u32){
+        let plates:Vec<&[u8]>=stack.iter().map(|p|p.as_slice()).collect();
+        check_engines(&plates,w,h);
+    }
+
+    #[test]
+    fn hand_made(){
+        let (w,h)=(7u32,6u32);
+        let px=|pts:&[(u32,u32)]|{
+            let mut m=vec![0u8;(w*h)as usize];
+            for &(x,y) in pts{ m[(y*w+x)as usize]=1; }
+            m
+        };
+        // single pixels touching diagonally
+        run(&[px(&[(2,2)]),px(&[(3,3)])],w,h);
+        // same, at the canvas corners and edges
+        run(&[px(&[(0,0),(6,5)]),px(&[(1,1),(5,4)]),px(&[(6,0)])],w,h);
+        // overlap (overprint keeps it) plus a plate that touches nothing
+        run(&[px(&[(1,1),(2,1),(3,1)]),px(&[(2,1),(2,2),(2,3)]),px(&[(6,5)])],w,h);
+        // one plate below another that covers it completely
+        run(&[px(&[(3,3)]),px(&[(2,3),(3,3),(4,3),(3,2),(3,4)])],w,h);
+        // empty and single-plate stacks
+        run(&[vec![0u8;(w*h)as usize],px(&[(1,1)])],w,h);
+        run(&[px(&[(1,1)])],w,h);
+
+        // trapPx 0: the only trap pixel is an isolated overlap and the only
+        // touch is diagonal, in another refine tile
+        let (w,h)=(150u32,8u32);
+        let mut a=vec![0u8;(w*h)as usize];
+        let mut b=a.clone();
+        a[(5*w+5)as usize]=1;
+        b[(5*w+5)as usize]=1;
+        a[(3*w+101)as usize]=1;
+        b[(4*w+102)as usize]=1;
+        run(&[a,b],w,h);
+    }
+
+    #[test]
+    fn thin_canvases(){
+        let mut rng=Rng(0x5eed);
+        for (w,h) in [(1,17),(17,1),(1,1),(2,9)]{
+            let stack:Vec<Vec<u8>>=(0..3).map(|_|noise(&mut rng,w,h,45)).collect();
+            run(&stack,w,h);
+        }
+    }
+
+    #[test]
+    fn random_overlapping(){
+        let mut rng=Rng(0x1234_5678_9abc);
+        for _ in 0..4{
+            let (w,h)=(20+rng.below(60),10+rng.below(40));
+            let stack=vec![rects(&mut rng,w,h,3),noise(&mut rng,w,h,20),rects(&mut rng,w,h,4),noise(&mut rng,w,h,5)];
+            run(&stack,w,h);
+        }
+    }
+
+    #[test]
+    fn random_disjoint(){
+        let mut rng=Rng(0xdead_beef);
+        for k in 2..5{
+            let (w,h)=(30+rng.below(50),20+rng.below(30));
+            run(&disjoint(&mut rng,w,h,k,70),w,h);
+        }
+    }
+
+    // Sparse objects on a canvas wider than one refine tile.
+    #[test]
+    fn random_sparse_objects(){
+        let mut rng=Rng(0x0b1ec7);
+        let (w,h)=(150u32,90u32);
+        let stack:Vec<Vec<u8>>=(0..3).map(|_|{
+            let mut m=vec![0u8;(w*h)as usize];
+            for _ in 0..5{
+                let (x0,y0)=(rng.below(w-6),rng.below(h-6));
+                for y in y0..y0+1+rng.below(5){
+                    for x in x0..x0+1+rng.below(5){ m[(y*w+x)as usize]=1; }
+                }
+            }
+            m
+        }).collect();
+        run(&stack,w,h);
+    }
+
+    // Misses fill the cache with fields up to FAR-1, later lookups at any
+    // width up to that hit, and every engine gives the same traps either way.
+    #[test]
+    fn cache_hit_matches_miss(){
+        let mut rng=Rng(0xcac4e);
+        let (w,h)=(40u32,30u32);
+        let dir=std::env::temp_dir().join(format!("smart_trapper_cache_test_{}",std::process::id()));
+        let _=std::fs::remove_dir_all(&dir);
+        let cache=DistCache::open(&dir,1<<30).unwrap();
+
+        // noisy plates (dense), rectangles (run lists) and a disjoint stack
+        let stacks=[
+            (0..3).map(|_|noise(&mut rng,w,h,30)).collect::<Vec<_>>(),
+            (0..3).map(|_|rects(&mut rng,w,h,2)).collect(),
+            disjoint(&mut rng,w,h,3,70),
+        ];
+        for stack in &stacks{
+            let plates:Vec<&[u8]>=stack.iter().map(|p|p.as_slice()).collect();
+            let key=mask_hash(plates[0],w,h);
+            assert!(cache.get(&key,w,h,0).is_none());
+            for r in [3,3,1,0,7]{
+                for mode in [Mode::Plates,Mode::Overprint]{
+                    let want=reference(&plates,mode,w,h,r);
+                    let ctx=format!("{:?} r={}",mode,r);
+                    assert_eq!(collect(|e|pairwise_traps(&plates,mode,w,h,r,Some(&cache),e)),want,"cached pairwise {}",ctx);
+                    for engine in [Engine::Auto,Engine::Objects]{
+                        let (_,got)=compute_traps(&plates,w,h,r,mode,engine,Some(&cache)).unwrap();
+                        assert_eq!(got,want,"cached {:?} {}",engine,ctx);
+                    }
+                    let coarse:Vec<Vec<u8>>=plates.iter().map(|p|preview::downsample_alpha(w,h,&rgba(p),2)).collect();
+                    let targets=(mode==Mode::Overprint).then(||overprint_targets(&plates,(w*h)as usize));
+                    let got=collect(|e|preview::refine(&plates,targets.as_deref(),&coarse,w,h,2,r,Some(&cache),e));
+                    assert_eq!(got,want,"cached refine {}",ctx);
+                }
+            }
+            assert_eq!(cache.get(&key,w,h,FAR-1),Some(edge_distance(plates[0],w,h,FAR-1)));
+        }
+        assert!(cache.get(&mask_hash(&stacks[0][0],w,h),w,h,FAR).is_none());
+        let _=std::fs::remove_dir_all(&dir);
+    }
+
+    #[test]
+    fn xxh64_reference_vectors(){
+        assert_eq!(xxh64(b"",0),0xef46db3751d8e999);
+        assert_eq!(xxh64(b"abc",0),0x44bc2cf5ad770999);
+        assert_eq!(xxh64(b"Nobody inspects the spammish repetition",0),0xfbcea83c8a378bf1);
+    }
+
+    #[test]
+    fn mask_hash_separates_high_bytes(){
+        // same set-byte count, different offsets and canvas shape
+        let (w,h)=(64u32,4u32);
+        let mut a=vec![0u8;(w*h)as usize];
+        let mut b=a.clone();
+        for i in [7,111]{ a[i]=1; }
+        for i in [15,39]{ b[i]=1; }
+        assert_ne!(mask_hash(&a,w,h),mask_hash(&b,w,h));
+        assert_ne!(mask_hash(&a,w,h),mask_hash(&a,h,w));
+    }
+}
@@ -1,10 +1,21 @@
 use anyhow::{Context, Result};
 use clap::Parser;
 use image::{ImageBuffer, Rgba};
-use serde::{Deserialize, Serialize};
-use std::collections::{HashMap, VecDeque};
+use manifest::{Delta, TrapSpec, TrapsOut};
+use serde::Deserialize;
+use smart_trapper::cache::DistCache;
+use smart_trapper::{compute_traps_each, overprint_targets, preview, Emit, Engine, Mode};
+use std::collections::{HashMap, HashSet};
 use std::fs;
 use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::Mutex;
+use std::thread;
+use std::time::Instant;
+
+mod manifest;
+mod pipeline;
+mod plan;
 
 fn default_tolerance() -> u32 { 5 }
 
@@ -13,6 +24,38 @@ fn default_tolerance() -> u32 { 5 }
 struct Args {
     job_folder: String,
     trap_px: Option<i32>,
+
+    /// plates = auto-knockout, overprint = keep overlaps and trap the outer boundary only
+    #[arg(long, value_enum, default_value_t=Mode::Plates)]
+    mode: Mode,
+
+    /// auto = label map when separations don't overlap, else pairwise
+    #[arg(long, value_enum, default_value_t=Engine::Auto)]
+    engine: Engine,
+
+    /// Quick trap preview at 1/scale resolution, written to preview/
+    #[arg(long, value_name="SCALE", value_parser=clap::value_parser!(u32).range(2..))]
+    preview: Option<u32>,
+
+    /// With --preview: also run the full-resolution pass, only in tiles the preview flagged
+    #[arg(long, requires="preview")]
+    refine: bool,
+
+    /// Decoder and encoder pool size (default: CPU count, at most 4)
+    #[arg(long, value_name="N")]
+    io_threads: Option<usize>,
+
+    /// Keep per-source distance fields here and reuse them across jobs and trap widths
+    #[arg(long, value_name="DIR")]
+    cache_dir: Option<PathBuf>,
+
+    /// Size cap for --cache-dir; least recently used entries are evicted
+    #[arg(long, value_name="MB", default_value_t=1024)]
+    cache_max_mb: u64,
+
+    /// Peak memory budget; picks the fastest engine / io-threads plan estimated to fit
+    #[arg(long, value_name="MB")]
+    max_memory: Option<u64>,
 }
 
 #[derive(Debug, Deserialize)]
@@ -50,24 +93,13 @@ struct FileMeta {
     png: String,
 }
 
-#[derive(Debug, Serialize)]
-struct TrapSpec {
-    source: String,
-    target: String,
-    png: String,
-}
-
-#[derive(Debug, Serialize)]
-struct TrapsOut {
-    traps: Vec<TrapSpec>,
-}
 
 fn sanitize(s:&str)->String{
     s.chars().map(|c| if "/\\:*?\"<>|".contains(c){'_' } else {c}).collect()
 }
 
 fn read_mask_rgba(path:&Path)->Result<(u32,u32,Vec<u8>)>{
-    let img=image::open(path)?.to_rgba8();
+    let img=image::open(path)?.into_rgba8(); // no copy when already RGBA8
     let (w,h)=img.dimensions();
     Ok((w,h,img.into_raw()))
 }
@@ -80,140 +112,258 @@ fn alpha_to_bit(w:u32,h:u32,rgba:&[u8])->Vec<u8>{
     out
 }
 
-fn any_on(m:&[u8])->bool{ m.iter().any(|&v|v!=0) }
-
-fn dirs8()->[(i32,i32);8]{
-    [(-1,0),(1,0),(0,-1),(0,1),(-1,-1),(-1,1),(1,-1),(1,1)]
+fn default_io_threads()->usize{
+    thread::available_parallelism().map_or(2,|n|n.get()).min(4)
 }
 
-fn edt(mask:&[u8],w:u32,h:u32)->Vec<f32>{
-    let n=(w*h)as usize;
-    let mut dist=vec![1e9f32;n];
-    let mut q=VecDeque::new();
+// Writes one TRAP__ png into <dir_name>/ unless the previous run already
+// wrote the same mask there; returns its spec with hash, bbox and delta.
+fn write_trap_png(job_folder:&Path,dir_name:&str,plate_names:&[String],prev:&HashMap<(String,String),TrapSpec>,lower:usize,upper:usize,trap_mask:&[u8],w:u32,h:u32)->Result<TrapSpec>{
+    let src=plate_names[lower].clone();
+    let tgt=plate_names[upper].clone();
 
-    for i in 0..n{
-        if mask[i]!=0{ dist[i]=0.0; q.push_back(i); }
-    }
+    let file_name=format!("TRAP__{}_over_{}.png",sanitize(&src),sanitize(&tgt));
+    let out_path=job_folder.join(dir_name).join(&file_name);
+    let png=format!("{}/{}",dir_name,file_name);
 
-    while let Some(idx)=q.pop_front(){
-        let x=(idx as u32%w)as i32;
-        let y=(idx as u32/w)as i32;
-
-        for (dx,dy) in [(1,0),(-1,0),(0,1),(0,-1)]{
-            let nx=x+dx;
-            let ny=y+dy;
-            if nx<0||ny<0||nx>=w as i32||ny>=h as i32{continue;}
-            let nidx=(ny as u32*w+nx as u32)as usize;
-            if dist[nidx]>dist[idx]+1.0{
-                dist[nidx]=dist[idx]+1.0;
-                q.push_back(nidx);
+    let hash=manifest::mask_hash(trap_mask,w,h);
+    let status=manifest::classify(prev.get(&(src.clone(),tgt.clone())),&hash,&png,out_path.exists());
+
+    if status!=Delta::Unchanged{
+        let mut img=ImageBuffer::<Rgba<u8>,Vec<u8>>::new(w,h);
+        for y in 0..h{
+            for x in 0..w{
+                let idx=(y*w+x)as usize;
+                let a=if trap_mask[idx]!=0{255}else{0};
+                img.put_pixel(x,y,Rgba([255,255,255,a]));
             }
         }
+        img.save(&out_path).with_context(||format!("writing {}",out_path.display()))?;
     }
-    dist
-}
-
-fn main()->Result<()>{
-    let args=Args::parse();
 
-    let job_folder=PathBuf::from(&args.job_folder);
-    let job:JobFile=serde_json::from_str(
-        &fs::read_to_string(job_folder.join("job.json"))?
-    )?;
+    Ok(TrapSpec{
+        source:src,
+        target:tgt,
+        png,
+        hash:Some(hash),
+        bbox:manifest::mask_bbox(trap_mask,w,h),
+        status:Some(status),
+    })
+}
 
+// decode pool -> compute (this thread) -> encode pool, with bounded queues.
+//
+// Decoders load job.colors masks (at 1/scale when scale > 1). Compute needs
+// the whole stack, so it starts once every mask is in; from then on each
+// trap it emits is PNG-encoded into <dir_name>/ while the next one is
+// computed. The encode queue bounds how many finished trap masks are alive
+// at once (the label-map engine also holds one source color's buckets).
+// Writes the manifest (traps.json) to manifest_path with the delta against
+// the one already there; returns the plates.
+fn run_pipeline<F>(job:&JobFile,job_folder:&Path,scale:u32,dir_name:&str,manifest_path:&Path,threads:usize,compute:F)->Result<Vec<Vec<u8>>>
+where F:FnOnce(&[Vec<u8>],&mut Emit)->Result<()>{
     let w=job.widthPx;
     let h=job.heightPx;
-    let n=(w*h)as usize;
-
-    let trap_px=args.trap_px.unwrap_or(job.tolerance as i32).max(0);
-
-    // Load plates
-    let mut plate_names=Vec::new();
-    let mut plates=Vec::new();
+    let (ow,oh)=if scale>1{ preview::coarse_dims(w,h,scale) } else { (w,h) };
 
-    for c in &job.colors{
-        let f=job.files.iter().find(|f|f.name==c.name).unwrap();
-        let (mw,mh,rgba)=read_mask_rgba(&job_folder.join(&f.png))?;
-        if mw!=w||mh!=h{ anyhow::bail!("mask size mismatch"); }
-        plate_names.push(c.name.clone());
-        plates.push(alpha_to_bit(w,h,&rgba));
-    }
+    let plate_names:Vec<String>=job.colors.iter().map(|c|c.name.clone()).collect();
+    let files=job.colors.iter().map(|c|{
+        job.files.iter().find(|f|f.name==c.name)
+            .with_context(||format!("no mask file for color {}",c.name))
+    }).collect::<Result<Vec<&FileMeta>>>()?;
 
-    // Detect touching boundaries
-    let mut pair_boundary:HashMap<(usize,usize),Vec<u8>>=HashMap::new();
-    let neigh=dirs8();
-
-    for y in 0..h as i32{
-        for x in 0..w as i32{
-            let idx=(y as u32*w+x as u32)as usize;
-
-            for (dx,dy) in neigh{
-                let nx=x+dx;
-                let ny=y+dy;
-                if nx<0||ny<0||nx>=w as i32||ny>=h as i32{continue;}
-                let nidx=(ny as u32*w+nx as u32)as usize;
-
-                for a in 0..plates.len(){
-                    if plates[a][idx]==0{continue;}
-                    for b in 0..plates.len(){
-                        if a==b{continue;}
-                        if plates[b][nidx]==0{continue;}
-
-                        let lower=a.min(b);
-                        let upper=a.max(b);
-                        pair_boundary.entry((lower,upper))
-                            .or_insert_with(||vec![0u8;n])[idx]=1;
-                    }
+    // Kept so unchanged traps need no re-encode; stale files go at the end.
+    let traps_dir=job_folder.join(dir_name);
+    fs::create_dir_all(&traps_dir)?;
+    let prev=manifest::load_previous(manifest_path);
+    manifest::retire(manifest_path)?;
+
+    let (dec_tx,dec_rx)=pipeline::bounded::<(usize,Vec<u8>)>("decode->compute",threads);
+    let (enc_tx,enc_rx)=pipeline::bounded::<(usize,usize,Vec<u8>)>("compute->encode",threads*2);
+    let decode=pipeline::Stage::new("decode",threads);
+    let compute_stage=pipeline::Stage::new("compute",1);
+    let encode=pipeline::Stage::new("encode",threads);
+    let next=AtomicUsize::new(0);
+    let specs=Mutex::new(Vec::new());
+    let started=Instant::now();
+
+    let result=thread::scope(|sc|->Result<Vec<Vec<u8>>>{
+        let (files,next,decode,encode,specs,plate_names,prev)=(&files,&next,&decode,&encode,&specs,&plate_names,&prev);
+
+        let decoders:Vec<_>=(0..threads).map(|_|{
+            let tx=dec_tx.clone();
+            sc.spawn(move||->Result<()>{
+                loop{
+                    let k=next.fetch_add(1,Ordering::Relaxed);
+                    if k>=files.len(){ return Ok(()); }
+                    let mask=decode.time(||->Result<Vec<u8>>{
+                        let (mw,mh,rgba)=read_mask_rgba(&job_folder.join(&files[k].png))
+                            .with_context(||format!("decoding {}",files[k].png))?;
+                        if mw!=w||mh!=h{ anyhow::bail!("mask size mismatch"); }
+                        Ok(if scale>1{ preview::downsample_alpha(w,h,&rgba,scale) } else { alpha_to_bit(w,h,&rgba) })
+                    })?;
+                    tx.send((k,mask))?;
                 }
-            }
+            })
+        }).collect();
+        drop(dec_tx);
+
+        let encoders:Vec<_>=(0..threads).map(|_|{
+            let rx=enc_rx.clone();
+            sc.spawn(move||->Result<()>{
+                while let Some((lower,upper,mask))=rx.recv(){
+                    let spec=encode.time(||write_trap_png(job_folder,dir_name,plate_names,prev,lower,upper,&mask,ow,oh))?;
+                    specs.lock().unwrap().push((lower,upper,spec));
+                }
+                Ok(())
+            })
+        }).collect();
+        // Only the encoders hold the receiver, so if they all exit early
+        // (unwritable traps/) the next send fails instead of blocking.
+        let enc_stats=enc_rx.stats_handle();
+        drop(enc_rx);
+
+        let dec_stats=dec_rx.stats_handle();
+        let mut slots:Vec<Option<Vec<u8>>>=vec![None;files.len()];
+        let mut got=0;
+        while got<files.len(){
+            let Some((k,mask))=dec_rx.recv() else { break; };
+            slots[k]=Some(mask);
+            got+=1;
         }
-    }
+        drop(dec_rx);
 
-    let traps_dir=job_folder.join("traps");
-    if traps_dir.exists(){ fs::remove_dir_all(&traps_dir)?; }
-    fs::create_dir_all(&traps_dir)?;
+        let dec_res:Result<()>=decoders.into_iter().map(|d|d.join().unwrap()).collect();
+        dec_stats.report();
+        if got<files.len(){
+            dec_res?;
+            anyhow::bail!("decode stage stopped early");
+        }
 
-    let mut out=TrapsOut{traps:vec![]};
+        let plates:Vec<Vec<u8>>=slots.into_iter().map(Option::unwrap).collect();
+        let t=Instant::now();
+        let res=compute(&plates,&mut |lower,upper,mask| enc_tx.send((lower,upper,mask)));
+        compute_stage.add(t.elapsed().saturating_sub(enc_stats.producer_wait()));
+        drop(enc_tx);
+
+        let enc_res:Result<()>=encoders.into_iter().map(|e|e.join().unwrap()).collect();
+        enc_stats.report();
+        enc_res?;
+        res.map(|_|plates)
+    });
+
+    decode.report();
+    compute_stage.report();
+    encode.report();
+    println!("pipeline wall {:.2}s",started.elapsed().as_secs_f64());
+    let plates=result?;
+
+    let mut specs=specs.into_inner().unwrap();
+    specs.sort_by_key(|s|(s.0,s.1));
+    let traps:Vec<TrapSpec>=specs.into_iter().map(|s|s.2).collect();
+
+    let current:HashSet<(&str,&str)>=traps.iter().map(|t|(t.source.as_str(),t.target.as_str())).collect();
+    let mut removed:Vec<TrapSpec>=prev.into_values()
+        .filter(|t|!current.contains(&(t.source.as_str(),t.target.as_str())))
+        .map(|t|TrapSpec{status:Some(Delta::Removed),..t})
+        .collect();
+    removed.sort_by(|a,b|(&a.source,&a.target).cmp(&(&b.source,&b.target)));
+
+    let keep:HashSet<&str>=traps.iter().filter_map(|t|Path::new(&t.png).file_name()?.to_str()).collect();
+    for entry in fs::read_dir(&traps_dir)?{
+        let path=entry?.path();
+        let stale=path.file_name().and_then(|f|f.to_str())
+            .map_or(false,|f|f.starts_with("TRAP__")&&f.ends_with(".png")&&!keep.contains(f));
+        if stale && path.is_file(){ fs::remove_file(&path)?; }
+    }
 
-    for ((lower,upper),_) in pair_boundary{
-        let dist=edt(&plates[lower],w,h);
-        let mut trap_mask=vec![0u8;n];
+    let out=TrapsOut{traps,removed};
+    println!("{}",manifest::summary(&out));
+    manifest::write(manifest_path,&out)?;
+    Ok(plates)
+}
 
-        for i in 0..n{
-            if plates[upper][i]!=0 && dist[i]<=trap_px as f32{
-                trap_mask[i]=1;
-            }
-        }
+fn run_engine(plates:&[Vec<u8>],w:u32,h:u32,trap_px:i32,mode:Mode,engine:Engine,cache:Option<&DistCache>,emit:&mut Emit)->Result<()>{
+    let plates:Vec<&[u8]>=plates.iter().map(|p|p.as_slice()).collect();
+    let engine=compute_traps_each(&plates,w,h,trap_px,mode,engine,cache,emit)?;
+    println!("engine: {:?}",engine);
+    Ok(())
+}
 
-        if !any_on(&trap_mask){continue;}
+fn main()->Result<()>{
+    let mut args=Args::parse();
 
-        let src=plate_names[lower].clone();
-        let tgt=plate_names[upper].clone();
+    let job_folder=PathBuf::from(&args.job_folder);
+    let job:JobFile=serde_json::from_str(
+        &fs::read_to_string(job_folder.join("job.json"))?
+    )?;
 
-        let file_name=format!("TRAP__{}_over_{}.png",sanitize(&src),sanitize(&tgt));
-        let out_path=traps_dir.join(&file_name);
+    let w=job.widthPx;
+    let h=job.heightPx;
 
-        let mut img=ImageBuffer::<Rgba<u8>,Vec<u8>>::new(w,h);
-        for y in 0..h{
-            for x in 0..w{
-                let idx=(y*w+x)as usize;
-                let a=if trap_mask[idx]!=0{255}else{0};
-                img.put_pixel(x,y,Rgba([255,255,255,a]));
-            }
+    let trap_px=args.trap_px.unwrap_or(job.tolerance as i32).max(0);
+    let threads=args.io_threads.unwrap_or_else(default_io_threads).max(1);
+
+    let plan=plan::choose(&plan::Job{
+        w,h,
+        colors:job.colors.len(),
+        trap_px,
+        mode:args.mode,
+        preview:args.preview.map(|s|(s,args.refine)),
+        cache:args.cache_dir.is_some(),
+    },args.engine,threads,args.max_memory.map(|m|m<<20))?;
+    args.engine=plan.engine;
+    let threads=plan.threads;
+
+    let manifest_path=job_folder.join("traps.json");
+    // The cache only saves work, so a dir that can't be used is not fatal.
+    let cache=args.cache_dir.as_deref().and_then(|d|{
+        DistCache::open(d,args.cache_max_mb<<20)
+            .map_err(|e|eprintln!("warning: running without distance cache: {:#}",e)).ok()
+    });
+
+    match args.preview{
+        None=>{
+            run_pipeline(&job,&job_folder,1,"traps",&manifest_path,threads,|plates,emit|{
+                run_engine(plates,w,h,trap_px,args.mode,args.engine,cache.as_ref(),emit)
+            })?;
         }
-        img.save(&out_path)?;
+        Some(scale)=>{
+            let (cw,ch)=preview::coarse_dims(w,h,scale);
+            let coarse_px=preview::scale_trap_px(trap_px,scale);
+            println!("preview: 1/{} ({}x{}), trapPx {} -> {}",scale,cw,ch,trap_px,coarse_px);
+            // OR-downsampling merges neighbouring plates into shared pixels,
+            // so the label map would refuse the coarse stack.
+            let coarse_engine=if args.engine==Engine::Labelmap{
+                println!("preview: coarse plates can overlap, using --engine auto instead of labelmap");
+                Engine::Auto
+            } else { args.engine };
+
+            let mut trap_union=vec![0u8;(cw*ch)as usize];
+            let coarse=run_pipeline(&job,&job_folder,scale,"preview",&job_folder.join("preview").join("traps.json"),threads,|plates,emit|{
+                run_engine(plates,cw,ch,coarse_px,args.mode,coarse_engine,cache.as_ref(),&mut |lower,upper,mask|{
+                    for (u,m) in trap_union.iter_mut().zip(&mask){ *u|=*m; }
+                    emit(lower,upper,mask)
+                })
+            })?;
+            preview::write_overlay(&job_folder.join("preview").join("overlay.png"),&coarse,&trap_union,cw,ch)?;
+
+            if !args.refine{
+                if let Some(c)=&cache{ c.report(); }
+                return Ok(());
+            }
 
-        out.traps.push(TrapSpec{
-            source:src,
-            target:tgt,
-            png:format!("traps/{}",file_name),
-        });
+            run_pipeline(&job,&job_folder,1,"traps",&manifest_path,threads,|plates,emit|{
+                let plates:Vec<&[u8]>=plates.iter().map(|p|p.as_slice()).collect();
+                let targets=match args.mode{
+                    Mode::Plates=>None,
+                    Mode::Overprint=>Some(overprint_targets(&plates,(w*h)as usize)),
+                };
+                preview::refine(&plates,targets.as_deref(),&coarse,w,h,scale,trap_px,cache.as_ref(),emit)
+            })?;
+        }
     }
 
-    fs::write(
-        job_folder.join("traps.json"),
-        serde_json::to_string_pretty(&out)?,
-    )?;
-
+    if let Some(c)=&cache{ c.report(); }
     Ok(())
-}
\ No newline at end of file
+}
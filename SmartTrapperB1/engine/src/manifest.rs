@@ -0,0 +1,106 @@
+// Delta against the previous traps.json in the job folder.
+//
+// Each trap records a content hash and bbox of its mask. On the next run the
+// same (source, target) is marked added / changed / unchanged, and traps
+// that disappeared are listed under "removed", so an importer can limit
+// Photoshop work to the delta. Unchanged traps keep their PNG untouched.
+//
+// The old traps.json is read, then removed before any PNG is written, and the
+// new one is renamed into place only when the run is complete. A run that
+// dies halfway therefore leaves no manifest: the importer sees the failure
+// and the next run starts from scratch instead of trusting hashes that no
+// longer describe the PNGs on disk.
+
+use anyhow::{Context, Result};
+use serde::{Deserialize, Serialize};
+use std::collections::HashMap;
+use std::fs;
+use std::path::Path;
+
+pub use smart_trapper::mask_hash;
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Serialize, Deserialize)]
+#[serde(rename_all="lowercase")]
+pub enum Delta {
+    Added,
+    Changed,
+    Unchanged,
+    Removed,
+}
+
+#[derive(Debug, Clone, Serialize, Deserialize)]
+pub struct TrapSpec {
+    pub source: String,
+    pub target: String,
+    pub png: String,
+
+    #[serde(default, skip_serializing_if="Option::is_none")]
+    pub hash: Option<String>,
+    /// [left, top, right, bottom], right/bottom exclusive
+    #[serde(default, skip_serializing_if="Option::is_none")]
+    pub bbox: Option<[u32;4]>,
+    #[serde(default, skip_serializing_if="Option::is_none")]
+    pub status: Option<Delta>,
+}
+
+#[derive(Debug, Default, Serialize, Deserialize)]
+pub struct TrapsOut {
+    pub traps: Vec<TrapSpec>,
+
+    #[serde(default)]
+    pub removed: Vec<TrapSpec>,
+}
+
+pub fn mask_bbox(mask:&[u8],w:u32,h:u32)->Option<[u32;4]>{
+    let mut bb:Option<[u32;4]>=None;
+    for y in 0..h{
+        let row=&mask[(y*w)as usize..((y+1)*w)as usize];
+        let Some(x0)=row.iter().position(|&v|v!=0) else { continue; };
+        let x1=row.iter().rposition(|&v|v!=0).unwrap()as u32+1;
+        let x0=x0 as u32;
+        bb=Some(match bb{
+            None=>[x0,y,x1,y+1],
+            Some([l,t,r,_])=>[l.min(x0),t,r.max(x1),y+1],
+        });
+    }
+    bb
+}
+
+// Previous specs by (source, target); empty if there is no readable traps.json.
+pub fn load_previous(path:&Path)->HashMap<(String,String),TrapSpec>{
+    let Ok(txt)=fs::read_to_string(path) else { return HashMap::new(); };
+    let Ok(prev)=serde_json::from_str::<TrapsOut>(&txt) else { return HashMap::new(); };
+    prev.traps.into_iter().map(|t|((t.source.clone(),t.target.clone()),t)).collect()
+}
+
+// Drops the manifest read by load_previous(): from here on the PNGs in the
+// traps folder may differ from it.
+pub fn retire(path:&Path)->Result<()>{
+    match fs::remove_file(path){
+        Err(e) if e.kind()!=std::io::ErrorKind::NotFound=>Err(e).with_context(||format!("removing {}",path.display())),
+        _=>Ok(()),
+    }
+}
+
+// Temp file + rename, so a reader never sees a partial manifest.
+pub fn write(path:&Path,out:&TrapsOut)->Result<()>{
+    let tmp=path.with_extension("json.tmp");
+    fs::write(&tmp,serde_json::to_string_pretty(out)?).with_context(||format!("writing {}",tmp.display()))?;
+    fs::rename(&tmp,path).with_context(||format!("writing {}",path.display()))
+}
+
+pub fn classify(prev:Option<&TrapSpec>,hash:&str,png:&str,png_exists:bool)->Delta{
+    match prev{
+        None=>Delta::Added,
+        Some(p) if p.hash.as_deref()==Some(hash) && p.png==png && png_exists=>Delta::Unchanged,
+        Some(_)=>Delta::Changed,
+    }
+}
+
+pub fn summary(out:&TrapsOut)->String{
+    let count=|d:Delta| out.traps.iter().filter(|t|t.status==Some(d)).count();
+    format!(
+        "delta: {} added, {} changed, {} unchanged, {} removed",
+        count(Delta::Added),count(Delta::Changed),count(Delta::Unchanged),out.removed.len(),
+    )
+}
@@ -0,0 +1,239 @@
+// Object-level trapping (--engine objects).
+//
+// Packaging artwork is many small objects scattered over a large canvas.
+// Each separation is split into 8-connected components, their bboxes go
+// into a grid index, and traps are only computed in the windows where a
+// component of the lower plate (grown by trapPx) meets a component of the
+// upper one. Windows overlap, so they are merged into flagged tiles first;
+// the lower plate is grown once over the tiles any of its pairs flagged
+// and each pair only ANDs its own tiles. Work scales with the contact area
+// between objects, not with the canvas.
+
+use crate::cache::DistCache;
+use crate::rle::RleMask;
+use crate::{any_on, cached_field, dilate_in_window, overprint_targets, Emit, Mode};
+use anyhow::Result;
+
+/// [left, top, right, bottom], right/bottom exclusive.
+pub type BBox=[u32;4];
+
+// Grid cell edge for the component index.
+const CELL:u32=256;
+
+// Tile edge the windows of a pair are merged into.
+const TILE:u32=64;
+
+// Above this share of the canvas covered by (grown) component boxes the
+// whole-plate pairwise pass is cheaper.
+const MAX_COVERAGE:f64=0.25;
+
+fn find(parent:&mut [usize],mut i:usize)->usize{
+    while parent[i]!=i{
+        parent[i]=parent[parent[i]];
+        i=parent[i];
+    }
+    i
+}
+
+// Bboxes of the 8-connected components, labelled on runs with union-find.
+pub fn components(mask:&[u8],w:u32,h:u32)->Vec<BBox>{
+    let rle=RleMask::from_dense(mask,w,h);
+    let mut boxes:Vec<BBox>=Vec::new();
+    let mut parent:Vec<usize>=Vec::new();
+    let mut prev:Vec<(u32,u32,usize)>=Vec::new();
+
+    for (y,runs) in rle.rows.iter().enumerate(){
+        let y=y as u32;
+        let mut cur=Vec::with_capacity(runs.len());
+        let mut j=0;
+        for &(s,e) in runs{
+            let id=parent.len();
+            parent.push(id);
+            boxes.push([s,y,e,y+1]);
+            // previous-row runs overlapping [s-1, e+1)
+            while j<prev.len()&&prev[j].1<s{ j+=1; }
+            let mut k=j;
+            while k<prev.len()&&prev[k].0<=e{
+                let (a,b)=(find(&mut parent,id),find(&mut parent,prev[k].2));
+                if a!=b{ parent[b]=a; }
+                k+=1;
+            }
+            cur.push((s,e,id));
+        }
+        prev=cur;
+    }
+
+    let mut roots:Vec<Option<usize>>=vec![None;parent.len()];
+    let mut out:Vec<BBox>=Vec::new();
+    for i in 0..parent.len(){
+        let r=find(&mut parent,i);
+        let k=*roots[r].get_or_insert_with(||{ out.push(boxes[i]); out.len()-1 });
+        let (o,b)=(&mut out[k],boxes[i]);
+        *o=[o[0].min(b[0]),o[1].min(b[1]),o[2].max(b[2]),o[3].max(b[3])];
+    }
+    out
+}
+
+fn grow(b:BBox,r:u32,w:u32,h:u32)->BBox{
+    [b[0].saturating_sub(r),b[1].saturating_sub(r),(b[2]+r).min(w),(b[3]+r).min(h)]
+}
+
+fn intersect(a:BBox,b:BBox)->Option<BBox>{
+    let i=[a[0].max(b[0]),a[1].max(b[1]),a[2].min(b[2]),a[3].min(b[3])];
+    if i[0]<i[2]&&i[1]<i[3]{ Some(i) } else { None }
+}
+
+fn area(b:BBox)->u64{ (b[2]-b[0])as u64*(b[3]-b[1])as u64 }
+
+// Uniform grid over box ids; query returns each candidate once.
+struct GridIndex {
+    cols:u32,
+    cells:Vec<Vec<usize>>,
+    boxes:Vec<BBox>,
+}
+
+impl GridIndex {
+    fn new(boxes:Vec<BBox>,w:u32,h:u32)->Self{
+        let (cols,rows)=((w+CELL-1)/CELL,(h+CELL-1)/CELL);
+        let mut cells=vec![Vec::new();(cols*rows)as usize];
+        for (k,b) in boxes.iter().enumerate(){
+            for cy in b[1]/CELL..=(b[3]-1)/CELL{
+                for cx in b[0]/CELL..=(b[2]-1)/CELL{ cells[(cy*cols+cx)as usize].push(k); }
+            }
+        }
+        GridIndex{cols,cells,boxes}
+    }
+
+    fn query(&self,b:BBox)->Vec<usize>{
+        let mut hits=Vec::new();
+        for cy in b[1]/CELL..=(b[3]-1)/CELL{
+            for cx in b[0]/CELL..=(b[2]-1)/CELL{
+                hits.extend(self.cells[(cy*self.cols+cx)as usize].iter()
+                    .filter(|&&k|intersect(self.boxes[k],b).is_some()));
+            }
+        }
+        hits.sort_unstable();
+        hits.dedup();
+        hits
+    }
+}
+
+// Some pixel of b inside region has an 8-neighbour (never itself) in a,
+// i.e. touching_pairs() restricted to region.
+pub fn touches_in(a:&[u8],b:&[u8],w:u32,h:u32,region:BBox)->bool{
+    for y in region[1]..region[3]{
+        for x in region[0]..region[2]{
+            if b[(y*w+x)as usize]==0{continue;}
+            for (dx,dy) in crate::dirs8(){
+                let nx=x as i64+dx as i64;
+                let ny=y as i64+dy as i64;
+                if nx<0||ny<0||nx>=w as i64||ny>=h as i64{continue;}
+                if a[(ny as u32*w+nx as u32)as usize]!=0{ return true; }
+            }
+        }
+    }
+    false
+}
+
+/// Component bboxes of every plate, in stack order.
+pub fn index(plates:&[&[u8]],w:u32,h:u32)->Vec<Vec<BBox>>{
+    plates.iter().map(|p|components(p,w,h)).collect()
+}
+
+/// Whether the object engine beats whole-plate pairwise for these plates.
+pub fn worthwhile(comps:&[Vec<BBox>],w:u32,h:u32,trap_px:i32)->bool{
+    if comps.is_empty(){ return false; }
+    let r=trap_px.max(1)as u32;
+    let covered:u64=comps.iter().flatten().map(|&b|area(grow(b,r,w,h))).sum();
+    (covered as f64/comps.len()as f64)<=MAX_COVERAGE*(w as f64*h as f64)
+}
+
+// Tiles covering box b, flagged in a tx-wide tile grid.
+fn flag_tiles(flagged:&mut [bool],tx:u32,b:BBox){
+    for ty in b[1]/TILE..=(b[3]-1)/TILE{
+        for t in b[0]/TILE..=(b[2]-1)/TILE{ flagged[(ty*tx+t)as usize]=true; }
+    }
+}
+
+// Runs of consecutive flagged tiles on each tile row, as boxes.
+fn strips(flagged:&[bool],tx:u32,w:u32,h:u32)->Vec<BBox>{
+    let mut out=Vec::new();
+    for (ty,row) in flagged.chunks(tx as usize).enumerate(){
+        let y0=ty as u32*TILE;
+        let mut x=0;
+        while x<row.len(){
+            if !row[x]{ x+=1; continue; }
+            let s=x;
+            while x<row.len()&&row[x]{ x+=1; }
+            out.push([s as u32*TILE,y0,(x as u32*TILE).min(w),(y0+TILE).min(h)]);
+        }
+    }
+    out
+}
+
+/// Same output as pairwise_traps(), streamed to emit in (lower, upper) order.
+/// With a cache, each lower plate's band comes from its cached_field().
+pub fn traps_each(plates:&[&[u8]],comps:Vec<Vec<BBox>>,mode:Mode,w:u32,h:u32,trap_px:i32,cache:Option<&DistCache>,emit:&mut Emit)->Result<()>{
+    let n=(w*h)as usize;
+    let r=trap_px.max(0)as u32;
+    let reach=r.max(1); // touching needs one pixel even at trapPx 0
+    let (tx,ty)=((w+TILE-1)/TILE,(h+TILE-1)/TILE);
+
+    let targets=match mode{
+        Mode::Plates=>None,
+        Mode::Overprint=>Some(overprint_targets(plates,n)),
+    };
+    let indexes:Vec<GridIndex>=comps.iter()
+        .map(|c|GridIndex::new(c.iter().map(|&b|grow(b,reach,w,h)).collect(),w,h))
+        .collect();
+
+    for lower in 0..plates.len(){
+        // flagged tiles per touching upper, and their union
+        let mut pair_tiles:Vec<(usize,Vec<bool>)>=Vec::new();
+        let mut any=vec![false;(tx*ty)as usize];
+        for upper in lower+1..plates.len(){
+            let mut flagged=vec![false;(tx*ty)as usize];
+            let mut windows=false;
+            let mut touching=false;
+
+            for &bj in &comps[upper]{
+                for i in indexes[lower].query(bj){
+                    let ai=comps[lower][i];
+                    if let Some(wnd)=intersect(grow(ai,r,w,h),bj){
+                        flag_tiles(&mut flagged,tx,wnd);
+                        windows=true;
+                    }
+                    if !touching{
+                        if let Some(reg)=intersect(grow(ai,1,w,h),bj){
+                            touching=touches_in(plates[lower],plates[upper],w,h,reg);
+                        }
+                    }
+                }
+            }
+            if !touching||!windows{continue;}
+            for (a,&f) in any.iter_mut().zip(&flagged){ *a|=f; }
+            pair_tiles.push((upper,flagged));
+        }
+        if pair_tiles.is_empty(){continue;}
+
+        // the lower plate's band, grown once per strip of flagged tiles
+        let field=cached_field(plates[lower],w,h,trap_px,cache);
+        let mut band=vec![0u8;n];
+        for s in strips(&any,tx,w,h){
+            dilate_in_window(plates[lower],field.as_deref(),w,h,trap_px,(s[0],s[1],s[2],s[3]),&mut band);
+        }
+
+        for (upper,flagged) in pair_tiles{
+            let target=targets.as_ref().map_or(plates[upper],|t|&t[upper]);
+            let mut trap_mask=vec![0u8;n];
+            for s in strips(&flagged,tx,w,h){
+                for y in s[1]..s[3]{
+                    let row=(y*w)as usize;
+                    for i in row+s[0] as usize..row+s[2] as usize{ trap_mask[i]=band[i]&(target[i]!=0) as u8; }
+                }
+            }
+            if any_on(&trap_mask){ emit(lower,upper,trap_mask)?; }
+        }
+    }
+    Ok(())
+}
@@ -0,0 +1,185 @@
+// Bounded queues and stage timers for the decode -> compute -> encode pipeline.
+//
+// Every queue counts how often a producer found it full (the consumer side
+// is the bottleneck) and how often a consumer found it empty (the producer
+// side is the bottleneck), plus the deepest it got. Stage timers add up busy
+// time per stage so the slowest stage stands out in the log.
+
+use anyhow::{anyhow, Result};
+use std::collections::VecDeque;
+use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+use std::sync::{Arc, Condvar, Mutex};
+use std::time::{Duration, Instant};
+
+// Counters are only updated with the queue locked, so items and depth are
+// exact: an item counts from the moment it is in the queue.
+#[derive(Debug)]
+pub struct QueueStats {
+    name:&'static str,
+    cap:usize,
+    max_depth:AtomicUsize,
+    items:AtomicUsize,
+    producer_stalls:AtomicUsize,
+    consumer_stalls:AtomicUsize,
+    producer_wait_ns:AtomicU64,
+}
+
+impl QueueStats {
+    pub fn producer_wait(&self)->Duration{
+        Duration::from_nanos(self.producer_wait_ns.load(Ordering::Relaxed))
+    }
+
+    // Only final once every producer and consumer is done.
+    pub fn report(&self){
+        println!(
+            "queue {}: cap {}, items {}, max depth {}, producer stalls {} ({:.2}s), consumer stalls {}",
+            self.name,self.cap,
+            self.items.load(Ordering::Relaxed),
+            self.max_depth.load(Ordering::Relaxed),
+            self.producer_stalls.load(Ordering::Relaxed),
+            self.producer_wait().as_secs_f64(),
+            self.consumer_stalls.load(Ordering::Relaxed),
+        );
+    }
+}
+
+struct State<T> {
+    items:VecDeque<T>,
+    senders:usize,
+    receivers:usize,
+}
+
+struct Queue<T> {
+    state:Mutex<State<T>>,
+    not_empty:Condvar,
+    not_full:Condvar,
+    stats:Arc<QueueStats>,
+}
+
+pub struct Sender<T> {
+    q:Arc<Queue<T>>,
+}
+
+impl<T> Clone for Sender<T> {
+    fn clone(&self)->Self{
+        self.q.state.lock().unwrap().senders+=1;
+        Sender{q:self.q.clone()}
+    }
+}
+
+impl<T> Drop for Sender<T> {
+    fn drop(&mut self){
+        self.q.state.lock().unwrap().senders-=1;
+        self.q.not_empty.notify_all();
+    }
+}
+
+impl<T> Sender<T> {
+    // Blocks while the queue is full (backpressure); fails once every
+    // receiver is gone.
+    pub fn send(&self,v:T)->Result<()>{
+        let (q,stats)=(&self.q,&self.q.stats);
+        let mut st=q.state.lock().unwrap();
+        if st.receivers>0&&st.items.len()>=stats.cap{
+            stats.producer_stalls.fetch_add(1,Ordering::Relaxed);
+            let t=Instant::now();
+            while st.receivers>0&&st.items.len()>=stats.cap{ st=q.not_full.wait(st).unwrap(); }
+            stats.producer_wait_ns.fetch_add(t.elapsed().as_nanos()as u64,Ordering::Relaxed);
+        }
+        if st.receivers==0{ return Err(anyhow!("{}: receiver gone",stats.name)); }
+        st.items.push_back(v);
+        stats.items.fetch_add(1,Ordering::Relaxed);
+        stats.max_depth.fetch_max(st.items.len(),Ordering::Relaxed);
+        q.not_empty.notify_one();
+        Ok(())
+    }
+}
+
+// Shared by a pool of consumers.
+pub struct Receiver<T> {
+    q:Arc<Queue<T>>,
+}
+
+impl<T> Clone for Receiver<T> {
+    fn clone(&self)->Self{
+        self.q.state.lock().unwrap().receivers+=1;
+        Receiver{q:self.q.clone()}
+    }
+}
+
+impl<T> Drop for Receiver<T> {
+    fn drop(&mut self){
+        self.q.state.lock().unwrap().receivers-=1;
+        self.q.not_full.notify_all();
+    }
+}
+
+impl<T> Receiver<T> {
+    // None once every sender is gone and the queue is drained.
+    pub fn recv(&self)->Option<T>{
+        let q=&self.q;
+        let mut st=q.state.lock().unwrap();
+        if st.items.is_empty()&&st.senders>0{
+            q.stats.consumer_stalls.fetch_add(1,Ordering::Relaxed);
+            while st.items.is_empty()&&st.senders>0{ st=q.not_empty.wait(st).unwrap(); }
+        }
+        let v=st.items.pop_front()?;
+        q.not_full.notify_one();
+        Some(v)
+    }
+
+    // Stats that outlive the receiver, so holding them does not keep the
+    // queue connected.
+    pub fn stats_handle(&self)->Arc<QueueStats>{ self.q.stats.clone() }
+}
+
+pub fn bounded<T>(name:&'static str,cap:usize)->(Sender<T>,Receiver<T>){
+    let stats=Arc::new(QueueStats{
+        name,
+        cap,
+        max_depth:AtomicUsize::new(0),
+        items:AtomicUsize::new(0),
+        producer_stalls:AtomicUsize::new(0),
+        consumer_stalls:AtomicUsize::new(0),
+        producer_wait_ns:AtomicU64::new(0),
+    });
+    let q=Arc::new(Queue{
+        state:Mutex::new(State{items:VecDeque::with_capacity(cap),senders:1,receivers:1}),
+        not_empty:Condvar::new(),
+        not_full:Condvar::new(),
+        stats,
+    });
+    (Sender{q:q.clone()},Receiver{q})
+}
+
+// Busy time summed over all workers of a stage.
+pub struct Stage {
+    name:&'static str,
+    workers:usize,
+    busy_ns:AtomicU64,
+}
+
+impl Stage {
+    pub fn new(name:&'static str,workers:usize)->Self{
+        Stage{name,workers,busy_ns:AtomicU64::new(0)}
+    }
+
+    pub fn time<R>(&self,f:impl FnOnce()->R)->R{
+        let t=Instant::now();
+        let r=f();
+        self.add(t.elapsed());
+        r
+    }
+
+    pub fn add(&self,d:Duration){
+        self.busy_ns.fetch_add(d.as_nanos()as u64,Ordering::Relaxed);
+    }
+
+    pub fn report(&self){
+        let busy=self.busy_ns.load(Ordering::Relaxed)as f64/1e9;
+        println!(
+            "stage {}: {} worker(s), busy {:.2}s, per worker {:.2}s",
+            self.name,self.workers,busy,busy/self.workers as f64,
+        );
+    }
+}
@@ -0,0 +1,183 @@
+// Up-front peak-memory / runtime estimates and plan choice (--max-memory).
+//
+// Only job.json is read: canvas size, color count, trapPx. Which pairs touch
+// and whether plates overlap are unknown until the masks are decoded, so
+// every color pair is assumed to touch. Memory is an upper bound; runtime is
+// a rough figure from nominal per-pixel throughputs, good for comparing
+// plans rather than for a stopwatch.
+//
+// A plan is an engine and an IO pool size. The engine is only varied when
+// --engine is auto, and then only between auto and no-labelmap: the label
+// map is the one engine that holds several full-size traps at once, while
+// the choice between objects and pairwise stays with the content test at run
+// time. Both pick per content: no-labelmap is costed at its cheaper branch
+// for time (the content test picks objects when that pays) and its larger
+// one for memory; auto runs the label map whenever plates are disjoint, so
+// it is costed at its slower and larger branch.
+
+use anyhow::{bail, Result};
+use smart_trapper::{Engine, Mode};
+
+// Nominal single-thread throughputs, pixels per second.
+const DECODE_PX_S:f64=60e6; // RGBA PNG decode + alpha extraction
+const ENCODE_PX_S:f64=40e6; // trap mask -> RGBA PNG
+const PASS_PX_S:f64=400e6; // one byte-per-pixel pass of the compute stage
+
+// Share of the canvas the objects engine still traps (objects::MAX_COVERAGE).
+const OBJECT_COVERAGE:f64=0.25;
+
+// Nominal share of a plate's pixels on its boundary: a band grown trapPx
+// out of it covers about EDGE_SHARE x trapPx of the canvas.
+const EDGE_SHARE:f64=0.02;
+
+// Cost of one band pixel grown ring by ring, in byte-per-pixel passes.
+const BAND_COST:f64=6.0;
+
+// Tile edge the objects engine merges its windows into (objects::TILE).
+const OBJECT_TILE:f64=64.0;
+
+#[derive(Debug, Clone, Copy)]
+pub struct Job {
+    pub w:u32,
+    pub h:u32,
+    pub colors:usize,
+    pub trap_px:i32,
+    pub mode:Mode,
+    /// --preview scale and whether --refine follows
+    pub preview:Option<(u32,bool)>,
+    pub cache:bool,
+}
+
+#[derive(Debug, Clone, Copy)]
+pub struct Plan {
+    pub engine:Engine,
+    pub threads:usize,
+    pub peak:u64,
+    pub secs:f64,
+}
+
+impl Job {
+    fn pixels(&self)->f64{ self.w as f64*self.h as f64 }
+
+    fn pairs(&self)->f64{
+        let c=self.colors as f64;
+        c*(c-1.0)/2.0
+    }
+
+    // Compute-stage temporaries beyond the decoded plates, in bytes.
+    fn engine_bytes(&self,engine:Engine,n:f64)->f64{
+        let c=self.colors as f64;
+        // the targets and one running stack union
+        let overprint=if self.mode==Mode::Overprint{ (c+1.0)*n } else { 0.0 };
+        // one source's cached distance field
+        let field=if self.cache{ n } else { 0.0 };
+        match engine{
+            // label map, visited flags and one source color's traps (every upper color)
+            Engine::Labelmap=>n*if self.colors>255{ 3.0 } else { 2.0 }+(c-1.0).max(0.0)*n+field,
+            // run lists kept for sparse plates, band, trap
+            Engine::Pairwise=>c*n/(2*self.trap_px.max(0)+1)as f64+2.0*n+field+overprint,
+            // lower plate's band, trap mask and window buffers
+            Engine::Objects=>3.0*n+field+overprint,
+            Engine::NoLabelmap=>self.engine_bytes(Engine::Pairwise,n).max(self.engine_bytes(Engine::Objects,n)),
+            Engine::Auto=>self.engine_bytes(Engine::Labelmap,n).max(self.engine_bytes(Engine::NoLabelmap,n)),
+        }
+    }
+
+    // Compute-stage passes over the canvas. Growing a source's band costs
+    // its area, which grows with trapPx until it covers the canvas.
+    fn engine_passes(&self,engine:Engine)->f64{
+        let c=self.colors as f64;
+        let p=self.pairs();
+        let r=self.trap_px.max(0)as f64;
+        let band=BAND_COST*(EDGE_SHARE*r).min(1.0);
+        let overprint=if self.mode==Mode::Overprint{ 2.0*c } else { 0.0 };
+        match engine{
+            // build, touch and boundary sweeps, one band per source, one bucket per pair
+            Engine::Labelmap=>c+12.0+c*band+p,
+            // dense touch test (8 neighbours), one copy + band per source, one AND per pair
+            Engine::Pairwise=>8.0*c+c*(1.0+band)+p+overprint,
+            // components per plate, then each lower plate's band over its
+            // tiles (plus a trapPx margin) and an AND per pair
+            Engine::Objects=>{
+                2.0*c+OBJECT_COVERAGE*((1.0+2.0*r/OBJECT_TILE)*c*(1.0+band)+p)+overprint
+            }
+            Engine::NoLabelmap=>self.engine_passes(Engine::Pairwise).min(self.engine_passes(Engine::Objects)),
+            Engine::Auto=>self.engine_passes(Engine::Labelmap).max(self.engine_passes(Engine::NoLabelmap)),
+        }
+    }
+
+    pub fn estimate(&self,engine:Engine,threads:usize)->Plan{
+        let full=self.pixels();
+        let (n,extra)=match self.preview{
+            None=>(full,0.0),
+            Some((s,false))=>(full/(s as f64*s as f64),0.0),
+            // refine runs at full size and keeps the coarse plates around
+            Some((s,true))=>(full,self.colors as f64*full/(s as f64*s as f64)),
+        };
+        let c=self.colors as f64;
+        let t=threads as f64;
+
+        // decode: plates filling up, a full-size RGBA frame (even for the
+        // preview, which downsamples after decoding) + mask per decoder, queue
+        let decode=c*n+t*(4.0*full+n)+t*n;
+        // compute: plates, engine temporaries, encode queue (2 x threads)
+        // and an RGBA frame + mask per encoder, at the output size
+        let compute=c*n+self.engine_bytes(engine,n)+2.0*t*n+t*5.0*n;
+        let peak=decode.max(compute)+extra;
+
+        let decode_s=c*full/(DECODE_PX_S*t);
+        let compute_s=self.engine_passes(engine)*n/PASS_PX_S;
+        let encode_s=self.pairs()*n/(ENCODE_PX_S*t);
+        Plan{engine,threads,peak:peak as u64,secs:decode_s+compute_s.max(encode_s)}
+    }
+}
+
+fn mb(b:u64)->u64{ (b+(1<<20)-1)>>20 }
+
+impl Plan {
+    pub fn describe(&self)->String{
+        format!("{:?}, {} io thread(s): peak ~{} MB, ~{:.1}s",self.engine,self.threads,mb(self.peak),self.secs)
+    }
+}
+
+// The requested engine and pool size when there is no limit; otherwise the
+// fastest candidate that fits, falling back from auto to no-labelmap and to
+// smaller IO pools. Fails before anything is allocated when
+// no plan fits.
+pub fn choose(job:&Job,engine:Engine,threads:usize,max_memory:Option<u64>)->Result<Plan>{
+    println!(
+        "plan: {}x{}, {} colors, trapPx {}, {:?}",
+        job.w,job.h,job.colors,job.trap_px,job.mode,
+    );
+    let Some(limit)=max_memory else {
+        let plan=job.estimate(engine,threads);
+        println!("plan: {}",plan.describe());
+        return Ok(plan);
+    };
+
+    let engines=match engine{
+        Engine::Auto=>vec![Engine::Auto,Engine::NoLabelmap],
+        e=>vec![e],
+    };
+    let mut plans=Vec::new();
+    for e in engines{
+        for t in (1..=threads).rev(){ plans.push(job.estimate(e,t)); }
+    }
+    for p in &plans{
+        println!("  {} {}",if p.peak<=limit{ "fits" } else { "over" },p.describe());
+    }
+
+    // ties keep candidate order: auto first, larger pools first
+    let best=plans.iter().filter(|p|p.peak<=limit)
+        .min_by(|a,b|a.secs.total_cmp(&b.secs));
+    match best{
+        Some(p)=>{
+            println!("plan: {} (limit {} MB)",p.describe(),mb(limit));
+            Ok(*p)
+        }
+        None=>{
+            let least=plans.iter().min_by_key(|p|p.peak).unwrap();
+            bail!("no plan fits --max-memory {} MB; smallest is {}",mb(limit),least.describe());
+        }
+    }
+}
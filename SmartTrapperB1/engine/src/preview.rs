@@ -0,0 +1,143 @@
+// Low-resolution preview trapping (--preview <scale>).
+//
+// Masks are OR-downsampled in scale x scale boxes so thin features still
+// show up, trapPx is scaled to match, and the coarse result is written to
+// preview/ together with an overlay image. With --refine the full-resolution
+// pass only runs inside the tiles the preview flagged.
+
+use crate::cache::DistCache;
+use crate::objects::touches_in;
+use crate::{any_on, cached_field, dirs8, edt, trap_in_window, Emit};
+use image::{ImageBuffer, Rgba};
+use std::path::Path;
+
+// Full-resolution tile edge for --refine.
+pub const TILE:u32=64;
+
+pub fn coarse_dims(w:u32,h:u32,scale:u32)->(u32,u32){
+    ((w+scale-1)/scale,(h+scale-1)/scale)
+}
+
+pub fn scale_trap_px(trap_px:i32,scale:u32)->i32{
+    (trap_px+scale as i32-1)/scale as i32
+}
+
+// Coarse pixel is on if any full-resolution pixel in its box has alpha.
+pub fn downsample_alpha(w:u32,h:u32,rgba:&[u8],scale:u32)->Vec<u8>{
+    let (cw,ch)=coarse_dims(w,h,scale);
+    let mut out=vec![0u8;(cw*ch)as usize];
+    for y in 0..h{
+        let row=(y/scale*cw)as usize;
+        for x in 0..w{
+            if rgba[((y*w+x)*4+3)as usize]>0{ out[row+(x/scale)as usize]=1; }
+        }
+    }
+    out
+}
+
+// Paper white, any plate grey, traps (union of all trap masks) red.
+pub fn write_overlay(path:&Path,plates:&[Vec<u8>],traps:&[u8],w:u32,h:u32)->anyhow::Result<()>{
+    let mut img=ImageBuffer::<Rgba<u8>,Vec<u8>>::new(w,h);
+    for y in 0..h{
+        for x in 0..w{
+            let idx=(y*w+x)as usize;
+            let px=if traps[idx]!=0{
+                Rgba([255,0,0,255])
+            } else if plates.iter().any(|p|p[idx]!=0){
+                Rgba([160,160,160,255])
+            } else {
+                Rgba([255,255,255,255])
+            };
+            img.put_pixel(x,y,px);
+        }
+    }
+    img.save(path)?;
+    Ok(())
+}
+
+// Pairs whose coarse masks share or 8-neighbour a coarse pixel: every pair
+// that touches at full resolution is among them.
+fn near_pairs(coarse:&[Vec<u8>],cw:u32,ch:u32)->Vec<(usize,usize)>{
+    let mut near=vec![false;coarse.len()*coarse.len()];
+    for y in 0..ch as i32{
+        for x in 0..cw as i32{
+            let idx=(y as u32*cw+x as u32)as usize;
+            let on:Vec<usize>=(0..coarse.len()).filter(|&k|coarse[k][idx]!=0).collect();
+            if on.is_empty(){continue;}
+            for (dx,dy) in dirs8().into_iter().chain([(0,0)]){
+                let nx=x+dx;
+                let ny=y+dy;
+                if nx<0||ny<0||nx>=cw as i32||ny>=ch as i32{continue;}
+                let nidx=(ny as u32*cw+nx as u32)as usize;
+                for &a in &on{
+                    for b in a+1..coarse.len(){
+                        if coarse[b][nidx]!=0{ near[a*coarse.len()+b]=true; }
+                    }
+                }
+            }
+        }
+    }
+    let c=coarse.len();
+    (0..c*c).filter(|&i|near[i]).map(|i|(i/c,i%c)).collect()
+}
+
+// Full-resolution traps, computed only in tiles where the coarse plates say
+// a trap is possible. Coarse boxes are supersets and coarse distances are at
+// most scale_trap_px()+1 for any full-resolution trap pixel (and at most 2
+// for a touching pixel), so nothing outside the flagged tiles can be part of
+// a trap or of the touch test. Candidate pairs come from the coarse plates;
+// the exact touch test only reads flagged tiles. With a cache, each lower
+// plate's distances come from its cached_field().
+pub fn refine(plates:&[&[u8]],targets:Option<&[Vec<u8>]>,coarse:&[Vec<u8>],w:u32,h:u32,scale:u32,trap_px:i32,cache:Option<&DistCache>,emit:&mut Emit)->anyhow::Result<()>{
+    let n=(w*h)as usize;
+    let (cw,ch)=coarse_dims(w,h,scale);
+    let reach=((scale_trap_px(trap_px,scale)+1).max(2))as f32;
+    let (tx,ty)=((w+TILE-1)/TILE,(h+TILE-1)/TILE);
+
+    let mut cached:Option<(usize,Vec<f32>)>=None;
+    let mut field:Option<(usize,Option<Vec<u8>>)>=None;
+    let mut tiles_run=0usize;
+
+    for (lower,upper) in near_pairs(coarse,cw,ch){
+        if cached.as_ref().map_or(true,|c|c.0!=lower){
+            cached=Some((lower,edt(&coarse[lower],cw,ch)));
+        }
+        let dist=&cached.as_ref().unwrap().1;
+
+        let mut flagged=vec![false;(tx*ty)as usize];
+        for cy in 0..ch{
+            for cx in 0..cw{
+                let ci=(cy*cw+cx)as usize;
+                if coarse[upper][ci]==0 || dist[ci]>reach{continue;}
+                let (bx0,by0)=(cx*scale,cy*scale);
+                let (bx1,by1)=(((cx+1)*scale).min(w)-1,((cy+1)*scale).min(h)-1);
+                for t_y in by0/TILE..=by1/TILE{
+                    for t_x in bx0/TILE..=bx1/TILE{ flagged[(t_y*tx+t_x)as usize]=true; }
+                }
+            }
+        }
+
+        let tiles:Vec<[u32;4]>=(0..tx*ty).filter(|&t|flagged[t as usize]).map(|t|{
+            let (x0,y0)=((t%tx)*TILE,(t/tx)*TILE);
+            [x0,y0,(x0+TILE).min(w),(y0+TILE).min(h)]
+        }).collect();
+        if !tiles.iter().any(|&t|touches_in(plates[lower],plates[upper],w,h,t)){continue;}
+
+        if field.as_ref().map_or(true,|f|f.0!=lower){
+            field=Some((lower,cached_field(plates[lower],w,h,trap_px,cache)));
+        }
+        let src_field=field.as_ref().unwrap().1.as_deref();
+
+        let target=targets.map_or(plates[upper],|t|&t[upper]);
+        let mut trap_mask=vec![0u8;n];
+        for t in tiles{
+            trap_in_window(plates[lower],src_field,target,w,h,trap_px,(t[0],t[1],t[2],t[3]),&mut trap_mask);
+            tiles_run+=1;
+        }
+
+        if any_on(&trap_mask){ emit(lower,upper,trap_mask)?; }
+    }
+
+    println!("refine: {} tile passes ({} tiles per pair)",tiles_run,tx*ty);
+    Ok(())
+}
@@ -0,0 +1,94 @@
+// In-process Python front end: the trapping core without the job-folder
+// PNG round trip. Built with `maturin build --release` (pyproject.toml).
+//
+//   import smart_trapper
+//   traps = smart_trapper.trap(
+//       [("Cyan", "BlendMode.NORMAL", cyan), ("Red", "BlendMode.MULTIPLY", red)],
+//       5, mode="plates", cache_dir="/var/cache/smart_trapper")
+//   for t in traps: t["source"], t["target"], t["blendMode"], t["mask"]
+//
+// Masks are 2-D uint8 arrays (nonzero = ink), bottom -> top like job.colors.
+// C-contiguous arrays are read in place, others are copied once. The GIL is
+// released while the engine runs; callers must not write to the arrays then.
+
+use crate::cache::DistCache;
+use crate::{compute_traps, Engine, Mode};
+use clap::ValueEnum;
+use numpy::{IntoPyArray, PyArrayMethods, PyReadonlyArray2, PyUntypedArrayMethods};
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyDict;
+use std::borrow::Cow;
+
+fn mask_bytes<'a>(arr:&'a PyReadonlyArray2<'_,u8>)->Cow<'a,[u8]>{
+    match arr.as_slice(){
+        Ok(s)=>Cow::Borrowed(s),
+        Err(_)=>Cow::Owned(arr.as_array().iter().copied().collect()),
+    }
+}
+
+fn dims(arr:&PyReadonlyArray2<'_,u8>)->(usize,usize){
+    let s=arr.shape();
+    (s[0],s[1])
+}
+
+/// trap(colors, trap_px, mode="plates", engine="auto", cache_dir=None, cache_max_mb=1024)
+///
+/// colors: list of (name, blendMode, mask) bottom -> top.
+/// Returns one dict per trap: source, target, blendMode (of the source,
+/// which the trap layer takes on) and mask (uint8 HxW, 1 = trap).
+/// cache_dir enables the on-disk distance-field cache, as --cache-dir does
+/// for the CLI; an unusable dir just disables it. There is no KEY argument:
+/// the spread rule only reads the color plates, as the CLI does.
+#[pyfunction]
+#[pyo3(signature=(colors, trap_px, mode="plates", engine="auto", cache_dir=None, cache_max_mb=1024))]
+fn trap<'py>(
+    py:Python<'py>,
+    colors:Vec<(String,String,PyReadonlyArray2<'py,u8>)>,
+    trap_px:i32,
+    mode:&str,
+    engine:&str,
+    cache_dir:Option<std::path::PathBuf>,
+    cache_max_mb:u64,
+)->PyResult<Vec<Bound<'py,PyDict>>>{
+    let mode=<Mode as ValueEnum>::from_str(mode,true).map_err(PyValueError::new_err)?;
+    let engine=<Engine as ValueEnum>::from_str(engine,true).map_err(PyValueError::new_err)?;
+
+    let Some(first)=colors.first() else { return Ok(vec![]); };
+    let (h,w)=dims(&first.2);
+    for (name,_,m) in &colors{
+        if dims(m)!=(h,w){ return Err(PyValueError::new_err(format!("mask size mismatch: {}",name))); }
+    }
+    let w32=u32::try_from(w).map_err(|_|PyValueError::new_err("mask too wide"))?;
+    let h32=u32::try_from(h).map_err(|_|PyValueError::new_err("mask too tall"))?;
+
+    let planes:Vec<Cow<[u8]>>=colors.iter().map(|c|mask_bytes(&c.2)).collect();
+    let trap_px=trap_px.max(0);
+    // The cache only saves work, so a dir that can't be used is not fatal.
+    let cache=cache_dir.and_then(|d|{
+        DistCache::open(&d,cache_max_mb<<20)
+            .map_err(|e|eprintln!("warning: running without distance cache: {:#}",e)).ok()
+    });
+
+    let (_,traps)=py.allow_threads(||{
+        let plates:Vec<&[u8]>=planes.iter().map(|p|p.as_ref()).collect();
+        compute_traps(&plates,w32,h32,trap_px,mode,engine,cache.as_ref())
+    }).map_err(|e|PyValueError::new_err(e.to_string()))?;
+
+    let mut out=Vec::with_capacity(traps.len());
+    for (lower,upper,mask) in traps{
+        let d=PyDict::new_bound(py);
+        d.set_item("source",&colors[lower].0)?;
+        d.set_item("target",&colors[upper].0)?;
+        d.set_item("blendMode",&colors[lower].1)?;
+        d.set_item("mask",mask.into_pyarray_bound(py).reshape([h,w])?)?;
+        out.push(d);
+    }
+    Ok(out)
+}
+
+#[pymodule]
+fn smart_trapper(m:&Bound<'_,PyModule>)->PyResult<()>{
+    m.add_function(wrap_pyfunction!(trap,m)?)?;
+    Ok(())
+}
@@ -0,0 +1,226 @@
+// Run-length masks for line art.
+//
+// Comic / line-art plates are mostly long empty or solid runs, so the
+// pairwise rule is done on run lists instead of pixels: dilation expands
+// and merges intervals, and/and_not/or are run-list merges, and the touch
+// test compares neighbouring rows. Cost scales with the number of runs.
+//
+// encode_if_sparse() picks RLE per mask when its run count makes that
+// cheaper than the dense boundary growth.
+
+/// Half-open [start, end) run on one row.
+pub type Run=(u32,u32);
+
+// Rough cost of one expanded run relative to one dense pixel.
+const RLE_RUN_COST:usize=8;
+
+#[derive(Debug, Clone)]
+pub struct RleMask {
+    pub w:u32,
+    pub h:u32,
+    pub rows:Vec<Vec<Run>>,
+}
+
+// Sorted, disjoint, non-adjacent runs from runs sorted by start.
+fn coalesce(runs:&[Run])->Vec<Run>{
+    let mut out:Vec<Run>=Vec::with_capacity(runs.len());
+    for &(s,e) in runs{
+        match out.last_mut(){
+            Some(last) if s<=last.1=>{ last.1=last.1.max(e); }
+            _=>out.push((s,e)),
+        }
+    }
+    out
+}
+
+fn row_or(a:&[Run],b:&[Run])->Vec<Run>{
+    let mut all:Vec<Run>=Vec::with_capacity(a.len()+b.len());
+    let (mut i,mut j)=(0,0);
+    while i<a.len()||j<b.len(){
+        if j>=b.len()||(i<a.len()&&a[i].0<=b[j].0){ all.push(a[i]); i+=1; }
+        else { all.push(b[j]); j+=1; }
+    }
+    coalesce(&all)
+}
+
+fn row_and(a:&[Run],b:&[Run])->Vec<Run>{
+    let mut out=Vec::new();
+    let (mut i,mut j)=(0,0);
+    while i<a.len()&&j<b.len(){
+        let s=a[i].0.max(b[j].0);
+        let e=a[i].1.min(b[j].1);
+        if s<e{ out.push((s,e)); }
+        if a[i].1<b[j].1{ i+=1; } else { j+=1; }
+    }
+    out
+}
+
+fn row_and_not(a:&[Run],b:&[Run])->Vec<Run>{
+    let mut out=Vec::new();
+    let mut j=0;
+    for &(s,e) in a{
+        let mut s=s;
+        while j<b.len()&&b[j].1<=s{ j+=1; }
+        let mut k=j;
+        while k<b.len()&&b[k].0<e{
+            if b[k].0>s{ out.push((s,b[k].0)); }
+            s=s.max(b[k].1);
+            k+=1;
+        }
+        if s<e{ out.push((s,e)); }
+    }
+    out
+}
+
+fn row_intersects(a:&[Run],b:&[Run])->bool{
+    let (mut i,mut j)=(0,0);
+    while i<a.len()&&j<b.len(){
+        if a[i].0.max(b[j].0)<a[i].1.min(b[j].1){ return true; }
+        if a[i].1<b[j].1{ i+=1; } else { j+=1; }
+    }
+    false
+}
+
+impl RleMask {
+    pub fn from_dense(mask:&[u8],w:u32,h:u32)->Self{
+        let mut rows=Vec::with_capacity(h as usize);
+        for y in 0..h{
+            let row=&mask[(y*w)as usize..((y+1)*w)as usize];
+            let mut runs=Vec::new();
+            let mut x=0u32;
+            while x<w{
+                if row[x as usize]==0{ x+=1; continue; }
+                let s=x;
+                while x<w&&row[x as usize]!=0{ x+=1; }
+                runs.push((s,x));
+            }
+            rows.push(runs);
+        }
+        RleMask{w,h,rows}
+    }
+
+    pub fn to_dense(&self)->Vec<u8>{
+        let mut out=vec![0u8;(self.w*self.h)as usize];
+        for (y,runs) in self.rows.iter().enumerate(){
+            let row=y*self.w as usize;
+            for &(s,e) in runs{ out[row+s as usize..row+e as usize].fill(1); }
+        }
+        out
+    }
+
+    // Dense AND, touching only the pixels inside runs.
+    pub fn and_dense(&self,dense:&[u8])->Vec<u8>{
+        let mut out=vec![0u8;(self.w*self.h)as usize];
+        for (y,runs) in self.rows.iter().enumerate(){
+            let row=y*self.w as usize;
+            for &(s,e) in runs{
+                for i in row+s as usize..row+e as usize{ out[i]=(dense[i]!=0) as u8; }
+            }
+        }
+        out
+    }
+
+    pub fn runs(&self)->usize{ self.rows.iter().map(|r|r.len()).sum() }
+
+    pub fn is_empty(&self)->bool{ self.rows.iter().all(|r|r.is_empty()) }
+
+    fn zip(&self,o:&Self,f:fn(&[Run],&[Run])->Vec<Run>)->Self{
+        RleMask{
+            w:self.w,
+            h:self.h,
+            rows:self.rows.iter().zip(&o.rows).map(|(a,b)|f(a,b)).collect(),
+        }
+    }
+
+    pub fn or(&self,o:&Self)->Self{ self.zip(o,row_or) }
+    pub fn and(&self,o:&Self)->Self{ self.zip(o,row_and) }
+    pub fn and_not(&self,o:&Self)->Self{ self.zip(o,row_and_not) }
+
+    // Diamond (4-connected distance <= r) dilation: row y+dy contributes its
+    // runs grown by r-|dy| on both sides, then the lot is merged.
+    pub fn dilate(&self,r:i32)->Self{
+        let (w,h)=(self.w as i64,self.h as i64);
+        let r=r.max(0) as i64;
+        let mut rows=Vec::with_capacity(self.h as usize);
+        let mut acc:Vec<Run>=Vec::new();
+        for y in 0..h{
+            acc.clear();
+            for sy in (y-r).max(0)..=(y+r).min(h-1){
+                let span=r-(sy-y).abs();
+                for &(s,e) in &self.rows[sy as usize]{
+                    acc.push(((s as i64-span).max(0)as u32,(e as i64+span).min(w)as u32));
+                }
+            }
+            acc.sort_unstable();
+            rows.push(coalesce(&acc));
+        }
+        RleMask{w:self.w,h:self.h,rows}
+    }
+
+    // Same rule as touching_pairs(): some pixel of self has an 8-neighbour
+    // (never itself) in o.
+    pub fn touches(&self,o:&Self)->bool{
+        let w=self.w;
+        for (y,runs) in self.rows.iter().enumerate(){
+            if runs.is_empty(){continue;}
+            let grown:Vec<Run>=runs.iter().map(|&(s,e)|(s.saturating_sub(1),(e+1).min(w))).collect();
+            let grown=coalesce(&grown);
+
+            if y>0 && row_intersects(&grown,&o.rows[y-1]){ return true; }
+            if y+1<o.rows.len() && row_intersects(&grown,&o.rows[y+1]){ return true; }
+
+            // Same row: a single-pixel run does not reach its own column.
+            let mut side:Vec<Run>=Vec::with_capacity(runs.len()*2);
+            for &(s,e) in runs{
+                if e-s>=2{ side.push((s.saturating_sub(1),(e+1).min(w))); }
+                else {
+                    if s>0{ side.push((s-1,s)); }
+                    if e<w{ side.push((e,e+1)); }
+                }
+            }
+            side.sort_unstable();
+            if row_intersects(&coalesce(&side),&o.rows[y]){ return true; }
+        }
+        false
+    }
+}
+
+// RLE when it beats the dense boundary growth for this trap width, else None.
+pub fn encode_if_sparse(mask:&[u8],w:u32,h:u32,trap_px:i32)->Option<RleMask>{
+    let m=RleMask::from_dense(mask,w,h);
+    let per_run=(2*trap_px.max(0)as usize+1)*RLE_RUN_COST;
+    if m.runs().saturating_mul(per_run)<=(w as usize)*(h as usize){ Some(m) } else { None }
+}
+
+// touching_pairs() on run lists, sorted by (lower, upper).
+pub fn touching_pairs(plates:&[&RleMask])->Vec<(usize,usize)>{
+    let mut pairs=Vec::new();
+    for a in 0..plates.len(){
+        if plates[a].is_empty(){continue;}
+        for b in a+1..plates.len(){
+            if plates[a].touches(plates[b]){ pairs.push((a,b)); }
+        }
+    }
+    pairs
+}
+
+// overprint_targets() on run lists: running prefix/suffix unions with or,
+// targets cut down with and_not.
+pub fn overprint_targets(plates:&[&RleMask])->Vec<RleMask>{
+    let Some(first)=plates.first() else { return vec![]; };
+    let empty=RleMask{w:first.w,h:first.h,rows:vec![Vec::new();first.h as usize]};
+
+    let mut acc=empty.clone();
+    let mut out=Vec::with_capacity(plates.len());
+    for p in plates{
+        out.push(p.and_not(&acc));
+        acc=acc.or(p);
+    }
+
+    let mut acc=empty;
+    for (p,t) in plates.iter().zip(&mut out).rev(){
+        *t=t.and_not(&acc);
+        acc=acc.or(p);
+    }
+    out
+}
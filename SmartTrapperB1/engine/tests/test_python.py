@@ -0,0 +1,71 @@
+# Smoke test for the Python module. From SmartTrapperB1/engine:
+#
+#   pip install maturin numpy pytest
+#   maturin develop --release
+#   pytest tests/test_python.py
+
+import pytest
+
+np = pytest.importorskip("numpy")
+smart_trapper = pytest.importorskip("smart_trapper")
+
+
+def square(h, w, x0, y0, x1, y1):
+    m = np.zeros((h, w), dtype=np.uint8)
+    m[y0:y1, x0:x1] = 255
+    return m
+
+
+def stack():
+    # Cyan on the left half, Red on the right half, touching at x=4|5
+    return [
+        ("Cyan", "BlendMode.NORMAL", square(6, 10, 0, 0, 5, 6)),
+        ("Red", "BlendMode.MULTIPLY", square(6, 10, 5, 0, 10, 6)),
+    ]
+
+
+def test_trap_spreads_lower_into_upper():
+    traps = smart_trapper.trap(stack(), 2)
+    assert len(traps) == 1
+    t = traps[0]
+    assert (t["source"], t["target"], t["blendMode"]) == ("Cyan", "Red", "BlendMode.NORMAL")
+    want = np.zeros((6, 10), dtype=np.uint8)
+    want[:, 5:7] = 1
+    assert t["mask"].dtype == np.uint8
+    assert t["mask"].shape == (6, 10)
+    assert np.array_equal(t["mask"], want)
+
+
+@pytest.mark.parametrize("engine", ["auto", "pairwise", "labelmap", "objects", "no-labelmap"])
+@pytest.mark.parametrize("mode", ["plates", "overprint"])
+def test_engines_agree(engine, mode):
+    want = smart_trapper.trap(stack(), 3, mode=mode, engine="pairwise")
+    got = smart_trapper.trap(stack(), 3, mode=mode, engine=engine)
+    assert [(t["source"], t["target"]) for t in got] == [(t["source"], t["target"]) for t in want]
+    for a, b in zip(got, want):
+        assert np.array_equal(a["mask"], b["mask"])
+
+
+def test_non_contiguous_masks_are_copied():
+    want = smart_trapper.trap(stack(), 1)
+    flipped = [(n, b, np.asfortranarray(m)) for n, b, m in stack()]
+    got = smart_trapper.trap(flipped, 1)
+    assert np.array_equal(got[0]["mask"], want[0]["mask"])
+
+
+def test_cache_dir(tmp_path):
+    want = smart_trapper.trap(stack(), 2)
+    for _ in range(2):  # miss, then hit
+        got = smart_trapper.trap(stack(), 2, cache_dir=str(tmp_path))
+        assert np.array_equal(got[0]["mask"], want[0]["mask"])
+    assert list(tmp_path.glob("*.dist"))
+
+
+def test_bad_input():
+    assert smart_trapper.trap([], 2) == []
+    with pytest.raises(ValueError):
+        smart_trapper.trap(stack() + [("Key", "BlendMode.NORMAL", np.zeros((3, 3), np.uint8))], 2)
+    with pytest.raises(ValueError):
+        smart_trapper.trap(stack(), 2, mode="sideways")
+    with pytest.raises(TypeError):  # KEY is not an input
+        smart_trapper.trap(stack(), 2, key=np.zeros((6, 10), np.uint8))